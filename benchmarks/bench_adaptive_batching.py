@@ -0,0 +1,126 @@
+"""Benchmark of adaptive batching in the asynchronous sender under step load.
+
+Run with ``python benchmarks/bench_adaptive_batching.py``. Events are sent to
+a local TCP sink at a paced rate that steps from sparse to peak traffic and
+back. For the sender without batching and with ``batch_max_latency`` set, it
+reports for each step:
+
+- the latency from `emit` until the sink has read the event,
+- the number of events per socket write,
+- the batching parameters at the end of the step (``batch_stats``).
+"""
+
+import bisect
+import statistics
+import time
+
+from bench_socket_options import Sink
+
+from fluent import asyncsender
+
+RECORD = {"message": "request handled", "levelname": "INFO", "status": 200}
+# (events per second, seconds)
+STEPS = ((200, 2.0), (50000, 2.0), (200, 2.0))
+CONFIGS = {
+    "no batching": {},
+    "batch_max_latency=10ms": {"batch_max_latency": 0.01},
+    "batch_max_latency=50ms": {"batch_max_latency": 0.05},
+}
+
+
+class TimingSink(Sink):
+    """Records when each byte count was reached"""
+
+    def __init__(self):
+        self.arrivals = ([], [])
+        super().__init__()
+
+    def _read(self, conn):
+        times, totals = self.arrivals
+        with conn:
+            while True:
+                data = conn.recv(1 << 20)
+                if not data:
+                    return
+                with self._cond:
+                    self.received += len(data)
+                    times.append(time.perf_counter())
+                    totals.append(self.received)
+                    self._cond.notify_all()
+
+
+def run(sink, options):
+    s = asyncsender.FluentSender(
+        "bench", host="127.0.0.1", port=sink.port, queue_maxsize=100000, **options
+    )
+    packet_size = len(s._make_packet("x", s._pack_timestamp(0), RECORD))
+    writes = []
+    send_data = s._send_data
+
+    def _send_data(bytes_, more=False):
+        writes.append(len(bytes_) // packet_size)
+        send_data(bytes_, more)
+
+    s._send_data = _send_data
+    # connect before measuring
+    s.emit("x", RECORD)
+    sink.wait_for(sink.received + packet_size)
+    writes.clear()
+
+    results = []
+    for rate, duration in STEPS:
+        base = sink.received
+        first_write = len(writes)
+        emitted = []
+        start = time.perf_counter()
+        n = int(rate * duration)
+        for i in range(n):
+            due = start + i / rate
+            ahead = due - time.perf_counter()
+            if ahead > 0.001:
+                time.sleep(ahead)
+            emitted.append(time.perf_counter())
+            s.emit("x", RECORD)
+        sink.wait_for(base + n * packet_size)
+        with sink._cond:
+            times, totals = (list(a) for a in sink.arrivals)
+        latencies = sorted(
+            times[bisect.bisect_left(totals, base + (i + 1) * packet_size)] - t
+            for i, t in enumerate(emitted)
+        )
+        batch = writes[first_write:]
+        results.append(
+            (
+                rate,
+                statistics.median(latencies),
+                latencies[int(len(latencies) * 0.99)],
+                n / max(len(batch), 1),
+                s.batch_stats,
+            )
+        )
+    s.close()
+    return results
+
+
+def main():
+    sink = TimingSink()
+    try:
+        for name, options in CONFIGS.items():
+            print(name)
+            for rate, median, p99, per_write, stats in run(sink, options):
+                line = (
+                    f"  {rate:6d} events/s  latency median {median * 1e3:7.2f} ms"
+                    f"  p99 {p99 * 1e3:7.2f} ms  {per_write:7.1f} events/write"
+                )
+                if stats:
+                    line += (
+                        f"  linger {stats['linger'] * 1e3:5.1f} ms"
+                        f"  batch_size {stats['batch_size']:7d}"
+                    )
+                print(line)
+    finally:
+        sink.close()
+
+
+if __name__ == "__main__":
+    main()
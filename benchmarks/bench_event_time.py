@@ -0,0 +1,47 @@
+"""Micro-benchmark for timestamp handling on the emit path.
+
+Run with ``python benchmarks/bench_event_time.py``. No fluentd is needed,
+packets are built but never sent.
+"""
+
+import time
+import timeit
+
+from fluent import sender
+
+N = 200000
+
+
+def bench(name, func):
+    best = min(timeit.repeat(func, number=N, repeat=7))
+    print(f"{name:<40} {best / N * 1e9:8.1f} ns/op")
+
+
+def main():
+    s = sender.FluentSender("app")
+    s._send = lambda bytes_, priority=None: True
+    record = {"message": "hello", "levelname": "INFO"}
+    now = time.time()
+    event_time = sender.EventTime(now)
+
+    bench("EventTime(float)", lambda: sender.EventTime(now))
+    bench("emit() seconds", lambda: s.emit("x", record))
+    bench("emit_with_time() int", lambda: s.emit_with_time("x", int(now), record))
+    s.nanosecond_precision = True
+    bench("emit() nanoseconds", lambda: s.emit("x", record))
+    bench("emit_with_time() float", lambda: s.emit_with_time("x", now, record))
+    bench(
+        "emit_with_time() EventTime", lambda: s.emit_with_time("x", event_time, record)
+    )
+
+    for source in ("cached", "monotonic"):
+        s = sender.FluentSender("app", timestamp_source=source)
+        s._send = lambda bytes_, priority=None: True
+        bench(f"emit() seconds, {source}", lambda s=s: s.emit("x", record))
+        s.nanosecond_precision = True
+        bench(f"emit() nanoseconds, {source}", lambda s=s: s.emit("x", record))
+        s.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Benchmark of the per-record cost of FluentRecordFormatter and packing.
+
+Run with ``python benchmarks/bench_formatter.py``. For the default layout
+(``sys_host``, ``sys_name``, ``sys_module``) in each format style, it reports
+the time to apply the layout, to format a whole record and to pack the
+resulting event, which is what a logging call costs before any I/O.
+"""
+
+import functools
+import logging
+import timeit
+
+from fluent import handler, sender
+
+NUMBER = 20000
+
+
+def per_call(func, *args):
+    func = functools.partial(func, *args)
+    return min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER
+
+
+def main():
+    record = logging.LogRecord(
+        "app.views",
+        logging.INFO,
+        "/srv/app/views.py",
+        42,
+        "handled in %dms",
+        (12,),
+        None,
+    )
+    s = sender.FluentSender("bench")
+    try:
+        for style in ("%", "{", "$"):
+            formatter = handler.FluentRecordFormatter(style=style)
+            data = formatter.format(record)
+            timestamp = s._pack_timestamp(0)
+            layout = per_call(formatter._format_by_dict, record)
+            format_ = per_call(formatter.format, record)
+            pack = per_call(s._make_packet, "app", timestamp, data)
+            print(
+                f"  style={style}  layout {layout * 1e9:7.0f} ns"
+                f"  format {format_ * 1e9:7.0f} ns  pack {pack * 1e9:7.0f} ns"
+            )
+    finally:
+        s.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark of FluentHandler with many threads logging concurrently.
+
+Run with ``python benchmarks/bench_handler_threads.py``. Records are sent to
+the local TCP sink of ``bench_socket_options.py``, so no fluentd is needed.
+For the synchronous and asynchronous handlers, with and without the handler
+lock around `emit` (``emit_lock``), it reports:
+
+- the rate at which the logging threads get their records through, which is
+  the time spent in request threads,
+- the mean and 99th percentile time of a single logging call.
+
+Records are delivered once the handler is closed, which is not timed.
+"""
+
+import logging
+import statistics
+import threading
+import time
+
+from bench_socket_options import Sink
+
+from fluent import asynchandler, handler
+
+RECORDS = 40000
+THREADS = (1, 4, 16, 64)
+
+
+def run(sink, handler_class, options, nthreads):
+    h = handler_class("bench", host="127.0.0.1", port=sink.port, **options)
+    h.setFormatter(handler.FluentRecordFormatter())
+    log = logging.getLogger(f"bench.{id(h)}")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.addHandler(h)
+    # connect before measuring
+    log.info("warm up")
+
+    per_thread = RECORDS // nthreads
+    barrier = threading.Barrier(nthreads + 1)
+    samples = [None] * nthreads
+
+    def worker(i):
+        timings = []
+        barrier.wait()
+        for n in range(per_thread):
+            start = time.perf_counter()
+            log.info("request %d handled", n)
+            timings.append(time.perf_counter() - start)
+        samples[i] = timings
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    log.removeHandler(h)
+    h.close()
+
+    timings = sorted(t for timings in samples for t in timings)
+    return (
+        len(timings) / elapsed,
+        statistics.mean(timings),
+        timings[int(len(timings) * 0.99)],
+    )
+
+
+def main():
+    sink = Sink()
+    try:
+        for label, handler_class, options in (
+            ("sync", handler.FluentHandler, {}),
+            ("async", asynchandler.FluentHandler, {"queue_maxsize": 10000}),
+        ):
+            for emit_lock in (True, False):
+                for nthreads in THREADS:
+                    rate, mean, p99 = run(
+                        sink,
+                        handler_class,
+                        dict(options, emit_lock=emit_lock),
+                        nthreads,
+                    )
+                    print(
+                        f"  {label:<5} emit_lock={emit_lock!s:<5} {nthreads:3d} threads"
+                        f" {rate:10.0f} records/s"
+                        f"  call mean {mean * 1e6:7.1f} us  p99 {p99 * 1e6:8.1f} us"
+                    )
+    finally:
+        sink.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Benchmark of the transport socket options.
+
+Run with ``python benchmarks/bench_socket_options.py``. Events are sent to a
+local TCP sink that reads and discards them, so no fluentd is needed. For
+small and large events it reports:
+
+- throughput of the synchronous and asynchronous senders,
+- latency from `emit` until the sink has read the whole event, one event at a
+  time, which is where Nagle's algorithm and corking show up.
+
+Loopback numbers are a lower bound of what these options change on a real
+network, but they show the relative effect of each one.
+"""
+
+import socket
+import statistics
+import threading
+import time
+
+from fluent import asyncsender, sender
+
+SMALL = {"message": "hello", "levelname": "INFO"}
+LARGE = {"message": "x" * 16384, "levelname": "INFO"}
+
+CONFIGS = {
+    "default": {},
+    "tcp_nodelay=False": {"tcp_nodelay": False},
+    "send_buffer_size=1MiB": {"send_buffer_size": 1 << 20},
+    "keepalive=True": {"keepalive": True, "keepalive_idle": 60},
+    "cork=True": {"cork": True},
+}
+
+
+class Sink(threading.Thread):
+    """Accepts connections and counts the bytes read"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(8)
+        self.port = self._sock.getsockname()[1]
+        self.received = 0
+        self._cond = threading.Condition()
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(1 << 20)
+                if not data:
+                    return
+                with self._cond:
+                    self.received += len(data)
+                    self._cond.notify_all()
+
+    def wait_for(self, nbytes):
+        with self._cond:
+            self._cond.wait_for(lambda: self.received >= nbytes)
+
+    def close(self):
+        self._sock.close()
+
+
+def throughput(sink, sender_class, record, n, **kwargs):
+    s = sender_class("bench", host="127.0.0.1", port=sink.port, **kwargs)
+    start_bytes = sink.received
+    packet_size = len(s._make_packet("x", s._pack_timestamp(0), record))
+    start = time.perf_counter()
+    for _ in range(n):
+        s.emit("x", record)
+    sink.wait_for(start_bytes + n * packet_size)
+    elapsed = time.perf_counter() - start
+    s.close()
+    return n / elapsed
+
+
+def latency(sink, sender_class, record, n, **kwargs):
+    s = sender_class("bench", host="127.0.0.1", port=sink.port, **kwargs)
+    packet_size = len(s._make_packet("x", s._pack_timestamp(0), record))
+    # connect before measuring
+    expected = sink.received + packet_size
+    s.emit("x", record)
+    sink.wait_for(expected)
+    samples = []
+    for _ in range(n):
+        expected += packet_size
+        start = time.perf_counter()
+        s.emit("x", record)
+        sink.wait_for(expected)
+        samples.append(time.perf_counter() - start)
+    s.close()
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99)]
+
+
+def main():
+    sink = Sink()
+    try:
+        for size, record, n in (("small", SMALL, 50000), ("large", LARGE, 5000)):
+            print(f"{size} events")
+            for name, kwargs in CONFIGS.items():
+                for label, sender_class in (
+                    ("sync", sender.FluentSender),
+                    ("async", asyncsender.FluentSender),
+                ):
+                    if name == "cork=True" and label == "sync":
+                        # only the asynchronous sender sends multi-part batches
+                        continue
+                    options = dict(kwargs)
+                    if label == "async":
+                        options["queue_maxsize"] = 1000
+                    rate = throughput(sink, sender_class, record, n, **options)
+                    median, p99 = latency(sink, sender_class, record, 1000, **options)
+                    print(
+                        f"  {label:<5} {name:<22} {rate:10.0f} events/s"
+                        f"  latency median {median * 1e6:7.1f} us"
+                        f"  p99 {p99 * 1e6:7.1f} us"
+                    )
+    finally:
+        sink.close()
+
+
+if __name__ == "__main__":
+    main()
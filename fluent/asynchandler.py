@@ -1,10 +1,169 @@
+import os
+import threading
+import time
+import weakref
+from queue import Empty, Full, Queue
+
 from fluent import asyncsender, handler
 
+_STOP = object()
+
+# Live handlers formatting in the background, reset in forked children
+_deferring_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for _handler in list(_deferring_handlers):
+        _handler._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 class FluentHandler(handler.FluentHandler):
     """
     Asynchronous Logging Handler for fluent.
+
+    :param defer_format: if True, records are formatted and packed by a
+        background thread of the handler instead of the logging thread.
+        The logging thread only takes a snapshot of the record: its
+        attributes, and a dict message or mapping of arguments, are copied,
+        the objects they refer to are not. Message arguments and exception
+        tracebacks are formatted later, arguments must not be modified once
+        logged. At most `queue_maxsize` records wait to be formatted, when
+        there are more the oldest is discarded if `queue_circular` is set,
+        the logging thread waits otherwise.
     """
 
+    def __init__(self, tag, *args, defer_format=False, **kwargs):
+        super().__init__(tag, *args, **kwargs)
+        self.defer_format = defer_format
+        self._format_thread = None
+        # set when close gave up waiting for the format thread
+        self._format_abandoned = False
+        if defer_format:
+            self._records_maxsize = kwargs.get(
+                "queue_maxsize", asyncsender.DEFAULT_QUEUE_MAXSIZE
+            )
+            self._records_circular = kwargs.get(
+                "queue_circular", asyncsender.DEFAULT_QUEUE_CIRCULAR
+            )
+            # created now, the format thread must not wait for the handler
+            # lock, held by close while it joins the thread
+            self.sender  # noqa: B018
+            self._start_formatting()
+            _deferring_handlers.add(self)
+
     def getSenderClass(self):
         return asyncsender.FluentSender
+
+    def _send_record(self, _sender, timestamp, data, record):
+        if (
+            not getattr(_sender, "queue_priorities", None)
+            and getattr(_sender, "flush_priority", None) is None
+        ):
+            return _sender.emit_with_time(None, timestamp, data)
+        # the record level is the event priority in the sender queue
+        return _sender.emit_with_time(None, timestamp, data, priority=record.levelno)
+
+    def _emit(self, record):
+        if self._format_thread is None:
+            # not deferring, or closed
+            return super()._emit(record)
+        snapshot = self._snapshot(record)
+        if not self._records_circular:
+            self._records.put(snapshot)
+            return True
+        while True:
+            try:
+                self._records.put(snapshot, block=False)
+                return True
+            except Full:
+                # discard the oldest
+                try:
+                    self._records.get(block=False)
+                except Empty:  # pragma: no cover
+                    continue
+                self._records.task_done()
+
+    @staticmethod
+    def _snapshot(record):
+        snapshot = record.__class__.__new__(record.__class__)
+        snapshot.__dict__.update(record.__dict__)
+        if isinstance(record.msg, dict):
+            snapshot.msg = dict(record.msg)
+        if isinstance(record.args, dict):
+            snapshot.args = dict(record.args)
+        return snapshot
+
+    def _start_formatting(self):
+        self._records = Queue(maxsize=self._records_maxsize)
+        self._format_thread = threading.Thread(
+            target=self._format_loop, name=f"FluentHandlerFormat {id(self)}"
+        )
+        self._format_thread.daemon = True
+        self._format_thread.start()
+
+    def _format_loop(self):
+        emit = super()._emit
+        while True:
+            record = self._records.get()
+            try:
+                if record is _STOP:
+                    return
+                if self._format_abandoned:
+                    continue
+                try:
+                    emit(record)
+                except Exception:  # noqa: BLE001 - reported like logging does
+                    self.handleError(record)
+            finally:
+                self._records.task_done()
+
+    def flush(self):
+        super().flush()
+        if self._format_thread is not None:
+            # wait until the records logged so far are handed to the sender,
+            # at most `timeout`: logging.shutdown() calls flush and must not
+            # hang while the sender is stuck on an unreachable collector
+            self._join_records(self._timeout)
+
+    def _join_records(self, timeout):
+        records = self._records
+        deadline = time.monotonic() + timeout
+        with records.all_tasks_done:
+            while records.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                records.all_tasks_done.wait(remaining)
+        return True
+
+    def _close_sender(self):
+        thread = self._format_thread
+        if thread is not None:
+            # records logged from now on are formatted by the logging thread
+            self._format_thread = None
+            self._records.put(_STOP)
+            thread.join(self._timeout)
+            if thread.is_alive():
+                # stuck sending: closing the sender releases it, the records
+                # left are dropped
+                self._format_abandoned = True
+                super()._close_sender()
+                return
+            # and so are the ones that raced with the stop
+            while True:
+                try:
+                    record = self._records.get(block=False)
+                except Empty:
+                    break
+                super()._emit(record)
+        super()._close_sender()
+
+    def _after_fork(self):
+        # the format thread is gone in the child, waiting records are the
+        # parent's to send
+        if self._format_thread is not None:
+            self._start_formatting()
@@ -1,4 +1,9 @@
+import atexit
+import collections
+import signal
 import threading
+import time
+import weakref
 from queue import Empty, Full, Queue
 
 from fluent import sender
@@ -8,11 +13,61 @@ __all__ = ["EventTime", "FluentSender"]
 
 DEFAULT_QUEUE_MAXSIZE = 100
 DEFAULT_QUEUE_CIRCULAR = False
+DEFAULT_BATCH_MAX_SIZE = 256 * 1024
+# Priority of events emitted without one, logging.INFO
+DEFAULT_PRIORITY = 20
 
 _TOMBSTONE = object()
 
+
+class _Urgent(bytes):
+    """A packed event at or above `flush_priority`"""
+
+
+class _Barrier(threading.Event):
+    """Queued by `flush`, set once the send thread has taken it"""
+
+    # whether the events queued before it were written
+    written = False
+
+
 _global_sender = None
 
+# Senders closed at interpreter exit, see `drain_at_exit`
+_draining_senders = weakref.WeakSet()
+
+
+def _drain_at_exit():
+    senders = list(_draining_senders)
+    if not senders:
+        return
+    # all of them are closed within the longest of their timeouts
+    deadline = time.monotonic() + max(s.drain_at_exit for s in senders)
+    for s in senders:
+        remaining = max(0.0, deadline - time.monotonic())
+        s.close(timeout=min(s.drain_at_exit, remaining))
+
+
+atexit.register(_drain_at_exit)
+
+
+def exit_on_signal(*signals):
+    """Makes the process exit normally on `signals`, SIGTERM by default.
+
+    A process terminated by a signal does not run `atexit` callbacks, so the
+    senders created with `drain_at_exit` would not be closed when, for
+    instance, a container is stopped. With this, the signals the process
+    does not handle yet raise `SystemExit` instead. Signals that already have
+    a handler are left alone. Must be called from the main thread.
+    """
+
+    def exit_(signum, frame):
+        raise SystemExit(128 + signum)
+
+    for signum in signals or (signal.SIGTERM,):
+        if signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, exit_)
+
 
 def _set_global_sender(sender):  # pragma: no cover
     """[For testing] Function to set global sender directly"""
@@ -33,6 +88,300 @@ def close():  # pragma: no cover
     get_global_sender().close()
 
 
+class _FifoQueue(Queue):
+    """Queue of packed events, used without `queue_priorities`.
+
+    Only events count towards `maxsize`: barriers are always accepted and
+    never discarded. A non-blocking `put` on a full queue discards the
+    oldest event and hands it to `overflow_handler`. Like `_PriorityQueue`,
+    the queue is closed once the tombstone is put: `put` refuses events and
+    returns False, waiting producers included.
+    """
+
+    def __init__(self, maxsize, overflow_handler):
+        super().__init__(maxsize)
+        self._overflow_handler = overflow_handler
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._events = 0
+        self._tombstone = False
+
+    def _put(self, item):
+        if type(item) is not _Barrier and item is not _TOMBSTONE:
+            self._events += 1
+        self.queue.append(item)
+
+    def _get(self):
+        item = self.queue.popleft()
+        if type(item) is not _Barrier and item is not _TOMBSTONE:
+            self._events -= 1
+        return item
+
+    def _is_full(self):
+        return 0 < self.maxsize <= self._events
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        if item is _TOMBSTONE:
+            with self.not_full:
+                self._tombstone = True
+                self._put(item)
+                self.not_empty.notify()
+                self.not_full.notify_all()
+            return True
+        discarded = None
+        with self.not_full:
+            if self._tombstone:
+                return False
+            if type(item) is _Barrier:
+                pass
+            elif block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._is_full():
+                    if self._tombstone:
+                        return False
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise Full
+                    self.not_full.wait(remaining)
+            elif self._is_full():
+                discarded = self._discard_oldest()
+            self._put(item)
+            self.not_empty.notify()
+        if discarded is not None:
+            self._overflow_handler(discarded)
+        return True
+
+    def _discard_oldest(self):
+        for i, item in enumerate(self.queue):
+            if type(item) is not _Barrier and item is not _TOMBSTONE:
+                del self.queue[i]
+                self._events -= 1
+                return item
+        return None  # pragma: no cover
+
+    def full(self):
+        with self.mutex:
+            return self._is_full()
+
+    def empty(self):
+        with self.mutex:
+            return not self._events
+
+    def qsize(self):
+        with self.mutex:
+            return self._events
+
+
+class _PriorityQueue:
+    """Queue of packed events split into priority classes.
+
+    `budgets` maps the lowest priority of each class to the number of bytes
+    the class may hold. `get` returns events of the highest non-empty class
+    first. When a class is out of budget, a blocking `put` waits until it has
+    room again and a non-blocking one discards the oldest events of that
+    class only, so that a flood of low priority events never pushes out or
+    delays high priority ones.
+
+    Once the tombstone is put, the queue is closed: `put` refuses events and
+    returns False, waiting producers included. A barrier is returned as soon
+    as the events put before it are taken or discarded, whatever was put
+    since, and before the tombstone.
+    """
+
+    def __init__(self, budgets, overflow_handler):
+        self._classes = sorted(budgets, reverse=True)
+        self._budgets = [budgets[c] for c in self._classes]
+        self._items = [collections.deque() for _ in self._classes]
+        self._bytes = [0] * len(self._classes)
+        self._dropped = [0] * len(self._classes)
+        # events ever put in each class, barriers wait for these positions
+        self._put_counts = [0] * len(self._classes)
+        self._overflow_handler = overflow_handler
+        self._barriers = collections.deque()
+        self._tombstone = False
+        self._not_empty = threading.Condition()
+        self._not_full = threading.Condition(self._not_empty._lock)
+
+    def class_index(self, priority):
+        if priority is None:
+            priority = DEFAULT_PRIORITY
+        for i, lowest in enumerate(self._classes):
+            if priority >= lowest:
+                return i
+        return len(self._classes) - 1
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        if item is _TOMBSTONE:
+            with self._not_empty:
+                self._tombstone = True
+                self._not_empty.notify()
+                self._not_full.notify_all()
+            return True
+        if type(item) is _Barrier:
+            with self._not_empty:
+                if self._tombstone:
+                    return False
+                self._barriers.append((item, list(self._put_counts)))
+                self._not_empty.notify()
+            return True
+
+        i = self.class_index(priority)
+        size = len(item)
+        budget = self._budgets[i]
+        items = self._items[i]
+        discarded = []
+        with self._not_full:
+            if self._tombstone:
+                return False
+            if block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while items and self._bytes[i] + size > budget:
+                    if self._tombstone:
+                        return False
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise Full
+                    self._not_full.wait(remaining)
+            else:
+                while items and self._bytes[i] + size > budget:
+                    oldest = items.popleft()
+                    self._bytes[i] -= len(oldest)
+                    self._dropped[i] += 1
+                    discarded.append(oldest)
+            items.append(item)
+            self._bytes[i] += size
+            self._put_counts[i] += 1
+            self._not_empty.notify()
+        for discarded_item in discarded:
+            self._overflow_handler(discarded_item)
+        return True
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._not_empty:
+            while True:
+                if self._barriers and self._passed(self._barriers[0][1]):
+                    return self._barriers.popleft()[0]
+                for i, items in enumerate(self._items):
+                    if items:
+                        item = items.popleft()
+                        self._bytes[i] -= len(item)
+                        self._not_full.notify_all()
+                        return item
+                if self._tombstone:
+                    return _TOMBSTONE
+                if not block:
+                    raise Empty
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                self._not_empty.wait(remaining)
+
+    def _passed(self, positions):
+        return all(
+            put - len(items) >= position
+            for put, items, position in zip(self._put_counts, self._items, positions)
+        )
+
+    def empty(self):
+        with self._not_empty:
+            return not any(self._items)
+
+    def qsize(self):
+        with self._not_empty:
+            return sum(len(items) for items in self._items)
+
+    def full(self):
+        return False
+
+    @property
+    def stats(self):
+        with self._not_empty:
+            return {
+                lowest: {"bytes": nbytes, "dropped": dropped}
+                for lowest, nbytes, dropped in zip(
+                    self._classes, self._bytes, self._dropped
+                )
+            }
+
+
+class _BatchController:
+    """Tunes the batches of the send thread to the traffic.
+
+    Tracks the arrival rate of events, their size, the time batches take to
+    send and the depth of the queue once a batch is taken. While events
+    queue up, batches are sent without waiting and double in size, up to
+    `max_size` bytes, to amortize the writes. Otherwise, after taking the
+    first event of a batch the thread waits for more (`linger`) only when
+    writes take a fair share of its time and more events are expected in
+    time for the batch to be sent within `max_latency` seconds.
+    `batch_size` is what is expected to arrive meanwhile. Sparse events
+    are sent right away.
+    """
+
+    MIN_SIZE = 16 * 1024
+    # seconds over which the arrival rate is averaged
+    WINDOW = 0.25
+    SMOOTHING = 0.2
+    # share of the time spent writing above which batches are waited for
+    BUSY = 0.1
+
+    def __init__(self, max_latency, max_size):
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self.linger = 0.0
+        self.batch_size = min(self.MIN_SIZE, max_size)
+        self.arrival_rate = 0.0
+        self.event_size = 0.0
+        self.send_latency = 0.0
+        self.queue_depth = 0
+        self._updated_at = time.monotonic()
+
+    def update(self, nevents, nbytes, send_latency, queue_depth):
+        now = time.monotonic()
+        elapsed = max(now - self._updated_at, 1e-6)
+        self._updated_at = now
+        weight = min(1.0, elapsed / self.WINDOW)
+        self.arrival_rate += weight * (nevents / elapsed - self.arrival_rate)
+        if self.event_size:
+            self.event_size += self.SMOOTHING * (nbytes / nevents - self.event_size)
+        else:
+            self.event_size = nbytes / nevents
+        self.send_latency += self.SMOOTHING * (send_latency - self.send_latency)
+        self.queue_depth = queue_depth
+
+        if queue_depth:
+            self.linger = 0.0
+            self.batch_size = min(self.max_size, self.batch_size * 2)
+            return
+        budget = max(0.0, self.max_latency - self.send_latency)
+        expected = self.arrival_rate * budget
+        # waiting is only worth it if it gathers more events and the thread
+        # spends a fair share of its time writing
+        busy = self.arrival_rate * self.send_latency
+        self.linger = budget if expected >= 2 and busy >= self.BUSY else 0.0
+        self.batch_size = int(
+            min(self.max_size, max(self.MIN_SIZE, expected * self.event_size))
+        )
+
+    @property
+    def stats(self):
+        return {
+            "linger": self.linger,
+            "batch_size": self.batch_size,
+            "arrival_rate": self.arrival_rate,
+            "send_latency": self.send_latency,
+            "queue_depth": self.queue_depth,
+        }
+
+
 class FluentSender(sender.FluentSender):
     def __init__(
         self,
@@ -48,11 +397,41 @@ class FluentSender(sender.FluentSender):
         queue_maxsize=DEFAULT_QUEUE_MAXSIZE,
         queue_circular=DEFAULT_QUEUE_CIRCULAR,
         queue_overflow_handler=None,
+        queue_priorities=None,
+        batch_max_latency=None,
+        batch_max_size=DEFAULT_BATCH_MAX_SIZE,
+        drain_at_exit=None,
         **kwargs,
     ):
         """
+        :param queue_priorities: enables priority queueing. Maps the lowest
+            priority of each class to its budget in bytes, for instance
+            ``{logging.ERROR: 1 << 20, logging.INFO: 4 << 20, 0: 1 << 20}``.
+            Events are assigned to the class of the highest lowest priority not
+            above their own, and sent highest class first. `queue_maxsize` is
+            not used in this mode.
+        :param batch_max_latency: enables adaptive batching. The send thread
+            writes the queued events in batches, sized and delayed from the
+            arrival rate, send latency and queue depth so that an event waits
+            at most about `batch_max_latency` seconds. See `batch_stats`.
+        :param batch_max_size: largest batch in bytes.
+        :param drain_at_exit: if set, the sender is closed at interpreter exit,
+            waiting at most this many seconds for the queued events to be
+            sent, see `close`. Also see `exit_on_signal`.
         :param kwargs: This kwargs argument is not used in __init__. This will be removed in the next major version.
         """
+        # set first, a shared transport is looked up by these as well
+        self._queue_maxsize = queue_maxsize
+        self._queue_circular = queue_circular
+        if queue_circular and queue_overflow_handler:
+            self._queue_overflow_handler = queue_overflow_handler
+        else:
+            self._queue_overflow_handler = self._queue_overflow_handler_default
+        self._queue_priorities = queue_priorities
+        self._batch_max_latency = batch_max_latency
+        self._batch_max_size = batch_max_size
+        self.drain_at_exit = drain_at_exit
+
         super().__init__(
             tag=tag,
             host=host,
@@ -65,38 +444,132 @@ class FluentSender(sender.FluentSender):
             msgpack_kwargs=msgpack_kwargs,
             **kwargs,
         )
-        self._queue_maxsize = queue_maxsize
-        self._queue_circular = queue_circular
-        if queue_circular and queue_overflow_handler:
-            self._queue_overflow_handler = queue_overflow_handler
-        else:
-            self._queue_overflow_handler = self._queue_overflow_handler_default
 
         self._thread_guard = (
             threading.Event()
         )  # This ensures visibility across all variables
         self._closed = False
+        # set when close gave up waiting for the send thread
+        self._abandoned = False
+
+        if self._transport is None:
+            self._start()
+            if drain_at_exit is not None:
+                _draining_senders.add(self)
 
-        self._queue = Queue(maxsize=queue_maxsize)
+    def _start(self):
+        if self._queue_priorities:
+            self._queue = _PriorityQueue(
+                self._queue_priorities, self._queue_overflow_handler
+            )
+        else:
+            self._queue = _FifoQueue(self._queue_maxsize, self._queue_overflow_handler)
+        self._batcher = None
+        if self._batch_max_latency is not None:
+            self._batcher = _BatchController(
+                self._batch_max_latency, self._batch_max_size
+            )
         self._send_thread = threading.Thread(
             target=self._send_loop, name="AsyncFluentSender %d" % id(self)
         )
         self._send_thread.daemon = True
         self._send_thread.start()
 
-    def close(self, flush=True):
+    def _after_fork(self):
+        super()._after_fork()
+        # The worker thread is gone in the child, queued events are the
+        # parent's to send.
+        if not self._closed and self._transport is None:
+            self._start()
+
+    def close(self, flush=True, timeout=None):
+        """Stops the send thread, once it has sent the queued events if `flush`.
+
+        With `timeout`, waits at most `timeout` seconds for them. The events
+        still queued then, and those the thread fails to send, are handed to
+        `buffer_overflow_handler`; the thread is left to finish the write in
+        progress on its own.
+        """
+        if self._transport is not None:
+            # the events are the shared transport's to flush or not
+            return super().close()
         with self.lock:
             if self._closed:
                 return
             self._closed = True
+            _draining_senders.discard(self)
+            self._clock.close()
             if not flush:
                 while True:
                     try:
-                        self._queue.get(block=False)
+                        item = self._queue.get(block=False)
                     except Empty:
                         break
+                    if type(item) is _Barrier:
+                        item.set()
+            # never waits for room, and releases the producers waiting for it
             self._queue.put(_TOMBSTONE)
-            self._send_thread.join()
+            self._send_thread.join(timeout)
+            if self._send_thread.is_alive():
+                self._abandon()
+            self._stop_prewarm()
+
+    def _abandon(self):
+        """Spills the queued events, the send thread stops after its write"""
+        self._abandoned = True
+        spilled = []
+        while True:
+            try:
+                bytes_ = self._queue.get(block=False)
+            except Empty:
+                break
+            if bytes_ is _TOMBSTONE:
+                break
+            if type(bytes_) is _Barrier:
+                bytes_.set()
+                continue
+            spilled.append(bytes_)
+        if not self._queue_priorities:
+            # taken along with the events
+            self._queue.put(_TOMBSTONE)
+        if spilled:
+            self._call_buffer_overflow_handler(b"".join(spilled))
+
+    def flush(self, timeout=None):
+        """Waits until the events emitted so far are written to the socket.
+
+        The send thread writes the events queued before a barrier, then
+        retries those it failed to write once; they are retried with backoff
+        until they are written or `timeout` seconds have passed, if given.
+        Returns whether they were all written. Events discarded meanwhile
+        from a full queue are not waited for. The send thread and the
+        connection are kept.
+        """
+        if self._transport is not None:
+            return self._transport.flush(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+            barrier = _Barrier()
+            if not self._send_waiting(barrier, remaining):
+                return False
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            if not barrier.wait(remaining):
+                return False
+            if barrier.written:
+                return True
+            if self._closed:
+                return False
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
 
     @property
     def queue_maxsize(self):
@@ -110,37 +583,142 @@ class FluentSender(sender.FluentSender):
     def queue_circular(self):
         return self._queue_circular
 
-    def _send(self, bytes_):
-        with self.lock:
-            if self._closed:
-                return False
-            if self._queue_circular and self._queue.full():
-                # discard oldest
-                try:
-                    discarded_bytes = self._queue.get(block=False)
-                except Empty:  # pragma: no cover
-                    pass
-                else:
-                    self._queue_overflow_handler(discarded_bytes)
-            try:
-                self._queue.put(bytes_, block=(not self._queue_circular))
-            except Full:  # pragma: no cover
-                return False  # this actually can't happen
+    @property
+    def queue_priorities(self):
+        return self._queue_priorities
 
-            return True
+    @property
+    def queue_stats(self):
+        """Queued bytes and discarded events per priority class.
+
+        Empty unless `queue_priorities` is set.
+        """
+        if not self._queue_priorities:
+            return {}
+        if self._transport is not None:
+            return self._transport.queue_stats
+        return self._queue.stats
+
+    @property
+    def batch_stats(self):
+        """Current parameters and measures of adaptive batching.
+
+        `linger` and `batch_size` are how long in seconds the send thread
+        waits for more events after the first of a batch and at how many
+        bytes it stops, `arrival_rate` is in events per second,
+        `send_latency` the time in seconds a batch takes to write and
+        `queue_depth` the number of events left queued after the last batch
+        was taken. Empty unless `batch_max_latency` is set.
+        """
+        if self._batch_max_latency is None:
+            return {}
+        if self._transport is not None:
+            return self._transport.batch_stats
+        return self._batcher.stats
+
+    def _send(self, bytes_, priority=None):
+        if self._is_urgent(priority):
+            bytes_ = _Urgent(bytes_)
+        # Not under self.lock, producers waiting for room must not hold up
+        # the other priority classes nor `close`. In circular mode the oldest
+        # event is discarded instead. The queue refuses events once closed.
+        return self._queue.put(
+            bytes_, block=not self._queue_circular, priority=priority
+        )
+
+    def _send_waiting(self, bytes_, timeout):
+        # Block on a full queue even in circular mode, so that streams are
+        # paused instead of discarding what is queued.
+        try:
+            return self._queue.put(bytes_, timeout=timeout)
+        except Full:
+            return False
 
     def _send_loop(self):
         send_internal = super()._send_internal
+        batcher = self._batcher
 
         try:
-            while True:
-                bytes_ = self._queue.get(block=True)
-                if bytes_ is _TOMBSTONE:
+            while not self._abandoned:
+                item = self._queue.get(block=True)
+                if item is _TOMBSTONE:
                     break
+                if type(item) is _Barrier:
+                    self._pass_barrier(item)
+                    continue
+                if batcher is None:
+                    more = type(item) is not _Urgent and not self._queue.empty()
+                    send_internal(item, self.cork and more)
+                    continue
 
-                send_internal(bytes_)
+                bytes_, nevents, urgent, item = self._gather(item, batcher)
+                queue_depth = self._queue.qsize()
+                start = time.monotonic()
+                send_internal(bytes_, self.cork and not urgent and queue_depth > 0)
+                batcher.update(
+                    nevents, len(bytes_), time.monotonic() - start, queue_depth
+                )
+                if item is _TOMBSTONE:
+                    break
+                if item is not None:
+                    self._pass_barrier(item)
         finally:
-            self._close()
+            if self.pendings:
+                # events the thread failed to send before being closed
+                self._call_buffer_overflow_handler(self.pendings)
+                self.pendings = None
+            self._close(linger=True)
+
+    def _gather(self, first, batcher):
+        """Takes the events following `first` off the queue into a batch.
+
+        Once an urgent event is taken, only the events already queued are
+        added. The batch ends at a barrier or the tombstone. Returns the
+        batch, its number of events, whether it holds an urgent event and the
+        barrier or tombstone taken, if any.
+        """
+        batch = [first]
+        size = len(first)
+        urgent = type(first) is _Urgent
+        deadline = time.monotonic() + (0.0 if urgent else batcher.linger)
+        while size < batcher.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    bytes_ = self._queue.get(timeout=remaining)
+                else:
+                    bytes_ = self._queue.get(block=False)
+            except Empty:
+                break
+            if bytes_ is _TOMBSTONE or type(bytes_) is _Barrier:
+                return b"".join(batch), len(batch), urgent, bytes_
+            batch.append(bytes_)
+            size += len(bytes_)
+            if type(bytes_) is _Urgent:
+                urgent = True
+                deadline = 0.0
+        return b"".join(batch), len(batch), urgent, None
+
+    def _pass_barrier(self, barrier):
+        if self.pendings:
+            super()._send_internal(b"")
+        barrier.written = not self.pendings
+        barrier.set()
+
+    def _transport_options(self):
+        options = super()._transport_options()
+        options.update(
+            queue_maxsize=self._queue_maxsize,
+            queue_circular=self._queue_circular,
+            queue_overflow_handler=None
+            if self._queue_overflow_handler == self._queue_overflow_handler_default
+            else self._queue_overflow_handler,
+            queue_priorities=self._queue_priorities,
+            batch_max_latency=self._batch_max_latency,
+            batch_max_size=self._batch_max_size,
+            drain_at_exit=self.drain_at_exit,
+        )
+        return options
 
     def _queue_overflow_handler_default(self, discarded_bytes):
         pass
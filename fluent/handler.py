@@ -1,8 +1,71 @@
+import builtins
+import collections
+import hashlib
 import json
 import logging
+import os
+import re
 import socket
+import threading
+import time
+import traceback
+import weakref
 
-from fluent import sender
+from fluent import sampling, sender
+
+# Live collapsers, reset in forked children
+_collapsers = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for collapser in list(_collapsers):
+        collapser._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+# Python 3.11 and up, rendered with the standard formatter
+_EXCEPTION_GROUPS = getattr(builtins, "BaseExceptionGroup", ())
+
+_TRACEBACK_HEADER = "Traceback (most recent call last):\n"
+_CAUSE_MESSAGE = (
+    "\nThe above exception was the direct cause of the following exception:\n\n"
+)
+_CONTEXT_MESSAGE = (
+    "\nDuring handling of the above exception, another exception occurred:\n\n"
+)
+
+
+# Templates of `fmt` values that only refer to a record attribute, by style
+_ATTRIBUTE_REFERENCES = {
+    None: re.compile(r"%\((\w+)\)s\Z"),
+    logging.StrFormatStyle: re.compile(r"\{([_A-Za-z]\w*)\}\Z"),
+    logging.StringTemplateStyle: re.compile(
+        r"\$(?:([_A-Za-z][_A-Za-z0-9]*)|\{([_A-Za-z][_A-Za-z0-9]*)\})\Z"
+    ),
+}
+
+
+def _format_exception_only(exc):
+    """The last line of a traceback, as `traceback.format_exception_only`.
+
+    That one renders the causes of `exc` as well, only to leave them out.
+    """
+    exc_type = type(exc)
+    if isinstance(exc, SyntaxError) or getattr(exc, "__notes__", None) is not None:
+        return "".join(traceback.format_exception_only(exc_type, exc))
+    try:
+        value = str(exc)
+    except Exception:  # noqa: BLE001 - rendered the standard way
+        return "".join(traceback.format_exception_only(exc_type, exc))
+    name = exc_type.__qualname__
+    module = exc_type.__module__
+    if module not in ("__main__", "builtins"):
+        name = f"{module}.{name}"
+    if not value:
+        return name + "\n"
+    return f"{name}: {value}\n"
 
 
 class FluentRecordFormatter(logging.Formatter):
@@ -24,6 +87,15 @@ class FluentRecordFormatter(logging.Formatter):
         except the ones specified by `exclude_attrs` are logged with the record as is.
         If `None`, operates as before, otherwise `fmt` is ignored.
         Can be an iterable.
+    :param traceback_cache_size: number of rendered tracebacks kept, keyed on
+        the exception types and code locations, so that repeated exceptions
+        are not rendered again. Only the exception messages are. 0 disables
+        the cache.
+    :param traceback_interval: if set, the traceback of an exception is sent
+        in full at most once every `traceback_interval` seconds, other records
+        only carry its last line. All of them carry an `exc_fingerprint`
+        identifying the traceback. Tracebacks dropped from the cache are sent
+        in full again.
     """
 
     def __init__(
@@ -34,6 +106,8 @@ class FluentRecordFormatter(logging.Formatter):
         fill_missing_fmt_key=False,
         format_json=True,
         exclude_attrs=None,
+        traceback_cache_size=256,
+        traceback_interval=None,
     ):
         super().__init__(None, datefmt)
 
@@ -77,6 +151,7 @@ class FluentRecordFormatter(logging.Formatter):
                 self.usesTime = self._format_by_dict_uses_time
             else:
                 if callable(fmt):
+                    self._fmt_dict = None
                     self._formatter = fmt
                     self.usesTime = fmt.usesTime
                 else:
@@ -84,6 +159,14 @@ class FluentRecordFormatter(logging.Formatter):
                     self._formatter = self._format_by_dict
                     self.usesTime = self._format_by_dict_uses_time
 
+        # (key, attribute, converter) or (key, None, function rendering the record)
+        self._fmt_fields = None
+        if self._fmt_dict is not None:
+            self._fmt_fields = [
+                (key, *self._compile_field(value))
+                for key, value in self._fmt_dict.items()
+            ]
+
         if format_json:
             self._format_msg = self._format_msg_json
         else:
@@ -93,7 +176,28 @@ class FluentRecordFormatter(logging.Formatter):
 
         self.fill_missing_fmt_key = fill_missing_fmt_key
 
+        self.traceback_cache_size = traceback_cache_size
+        self.traceback_interval = traceback_interval
+        # key -> [rendered stacks, fingerprint, time the full text was last sent]
+        self._tracebacks = collections.OrderedDict()
+        self._tracebacks_lock = threading.Lock()
+
     def format(self, record):
+        exc_info = record.exc_info
+        if self.traceback_interval is None or not exc_info or exc_info[1] is None:
+            return self._format(record)
+        text, fingerprint = self._format_exception_fingerprinted(exc_info)
+        # Not left on the record, other handlers render the traceback in full
+        exc_text = record.exc_text
+        record.exc_text = text
+        try:
+            data = self._format(record)
+        finally:
+            record.exc_text = exc_text
+        data["exc_fingerprint"] = fingerprint
+        return data
+
+    def _format(self, record):
         # Compute attributes handled by parent class.
         super().format(record)
         # Add ours
@@ -105,6 +209,108 @@ class FluentRecordFormatter(logging.Formatter):
         self._structuring(data, record)
         return data
 
+    def formatException(self, ei):
+        if not self.traceback_cache_size or ei[1] is None:
+            return super().formatException(ei)
+        chain = self._exception_chain(ei)
+        if chain is None:
+            return super().formatException(ei)
+        return self._render_exception(chain, self._cached_traceback(chain)[0])
+
+    def _format_exception_fingerprinted(self, ei):
+        chain = self._exception_chain(ei)
+        group = chain is None
+        if group:
+            chain = [(None, ei[1], ei[2])]
+        entry = self._cached_traceback(chain)
+        now = time.monotonic()
+        with self._tracebacks_lock:
+            full = entry[2] is None or now - entry[2] >= self.traceback_interval
+            if full:
+                entry[2] = now
+        if not full:
+            text = _format_exception_only(ei[1])
+        elif group:
+            text = super().formatException(ei)
+        else:
+            text = self._render_exception(chain, entry[0])
+        return text.rstrip("\n"), entry[1]
+
+    @staticmethod
+    def _exception_chain(ei):
+        """Returns `(message before, exception, traceback)` for the exception
+        and the ones it was raised from, innermost first as they are rendered.
+
+        None for exception groups, left to the standard formatter.
+        """
+        chain = []
+        exc, tb = ei[1], ei[2]
+        seen = set()
+        while exc is not None and id(exc) not in seen:
+            if isinstance(exc, _EXCEPTION_GROUPS):
+                return None
+            seen.add(id(exc))
+            if exc.__cause__ is not None:
+                chained_msg, chained_exc = _CAUSE_MESSAGE, exc.__cause__
+            elif exc.__context__ is not None and not exc.__suppress_context__:
+                chained_msg, chained_exc = _CONTEXT_MESSAGE, exc.__context__
+            else:
+                chained_msg, chained_exc = None, None
+            chain.append((chained_msg, exc, tb))
+            exc = chained_exc
+            tb = None if exc is None else exc.__traceback__
+        chain.reverse()
+        return chain
+
+    def _cached_traceback(self, chain):
+        key = []
+        for _, exc, tb in chain:
+            locations = []
+            while tb is not None:
+                locations.append((tb.tb_frame.f_code, tb.tb_lasti))
+                tb = tb.tb_next
+            key.append((type(exc), tuple(locations)))
+        key = tuple(key)
+        with self._tracebacks_lock:
+            entry = self._tracebacks.get(key)
+            if entry is not None:
+                self._tracebacks.move_to_end(key)
+                return entry
+        # rendered out of the lock, the source lines are read from the files
+        stacks = ["".join(traceback.format_tb(tb)) for _, _, tb in chain]
+        fingerprint = hashlib.sha1(
+            "\n".join(
+                f"{exc_type.__module__}.{exc_type.__qualname__}"
+                + "".join(
+                    f" {code.co_filename}:{code.co_name}:{lasti}"
+                    for code, lasti in locations
+                )
+                for exc_type, locations in key
+            ).encode()
+        ).hexdigest()[:16]
+        entry = [stacks, fingerprint, None]
+        if self.traceback_cache_size:
+            with self._tracebacks_lock:
+                entry = self._tracebacks.setdefault(key, entry)
+                if len(self._tracebacks) > self.traceback_cache_size:
+                    self._tracebacks.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _render_exception(chain, stacks):
+        parts = []
+        for (msg, exc, tb), stack in zip(chain, stacks):
+            if msg is not None:
+                parts.append(msg)
+            if tb is not None:
+                parts.append(_TRACEBACK_HEADER)
+                parts.append(stack)
+            parts.append(_format_exception_only(exc))
+        text = "".join(parts)
+        if text[-1:] == "\n":
+            text = text[:-1]
+        return text
+
     def usesTime(self):
         """This method is substituted on construction based on settings for performance reasons"""
 
@@ -146,14 +352,29 @@ class FluentRecordFormatter(logging.Formatter):
                 data[key] = value
         return data
 
+    def _compile_field(self, template):
+        """Returns how to render a `fmt` value, parsed once for all records.
+
+        Values only referring to an attribute, like the default ones, are
+        looked up directly instead of being formatted.
+        """
+        match = _ATTRIBUTE_REFERENCES[self.__style].match(template)
+        if match:
+            convert = format if self.__style is logging.StrFormatStyle else str
+            return match.group(match.lastindex), convert
+        if self.__style:
+            return None, self.__style(template).format
+        return None, lambda record: template % record.__dict__
+
     def _format_by_dict(self, record):
         data = {}
-        for key, value in self._fmt_dict.items():
+        attrs = record.__dict__
+        for key, attr, render in self._fmt_fields:
             try:
-                if self.__style:
-                    value = self.__style(value).format(record)
+                if attr is None:
+                    value = render(record)
                 else:
-                    value = value % record.__dict__
+                    value = render(attrs[attr])
             except KeyError as exc:
                 value = None
                 if not self.fill_missing_fmt_key:
@@ -176,9 +397,153 @@ class FluentRecordFormatter(logging.Formatter):
                 data[key] = value
 
 
+class RecordCollapser:
+    """Collapses bursts of repeated records.
+
+    Records are repeats when they share logger, level, message template
+    (`record.msg`) and source location. The first record of a burst passes
+    through; repeats within `window` seconds of it are held back and replaced
+    by a single record, the last repeat, carrying `repeat_count` and the
+    `first_timestamp` / `last_timestamp` of the repeats. At most `max_keys`
+    bursts are tracked; the least recently started one is closed when a new
+    one starts.
+
+    Bursts are closed when a later record arrives after their window, or on
+    `flush`. If `on_expire` is given, a background thread also closes them
+    when their window expires and calls it with each summary record, so
+    that held repeats are not kept back by a quiet logger.
+    """
+
+    def __init__(self, window, max_keys=1000, on_expire=None):
+        self.window = window
+        self.max_keys = max_keys
+        self.on_expire = on_expire
+        # fingerprint -> [window end, repeat count, first repeat time, last repeat]
+        self._bursts = collections.OrderedDict()
+        self._lock = threading.Condition()
+        self._closed = False
+        self._thread = None
+        _collapsers.add(self)
+
+    def collapse(self, record):
+        """Returns the records to emit in place of `record`"""
+        msg = record.msg
+        if not isinstance(msg, str):
+            return [record]
+        key = (record.name, record.levelno, msg, record.pathname, record.lineno)
+        now = record.created
+        with self._lock:
+            records = self._expire(now)
+            burst = self._bursts.get(key)
+            if burst is None:
+                if not self._bursts and self._thread is not None:
+                    # the expiry thread waits for a burst to start
+                    self._lock.notify()
+                self._bursts[key] = [now + self.window, 0, None, None]
+                if len(self._bursts) > self.max_keys:
+                    _, oldest = self._bursts.popitem(last=False)
+                    self._append_summary(records, oldest)
+                records.append(record)
+            else:
+                if not burst[1]:
+                    burst[2] = now
+                    if self.on_expire is not None and self._thread is None:
+                        self._start()
+                burst[1] += 1
+                burst[3] = record
+        return records
+
+    def flush(self):
+        """Returns the summary records of all the bursts, closing them"""
+        with self._lock:
+            records = []
+            for burst in self._bursts.values():
+                self._append_summary(records, burst)
+            self._bursts.clear()
+        return records
+
+    def close(self):
+        """Stops the expiry thread, if any, once it has handed over the
+        summaries it already closed"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _after_fork(self):
+        # held repeats are summarized by the parent, the expiry thread is
+        # restarted by the next repeat
+        self._bursts = collections.OrderedDict()
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._expiry_loop, name=f"FluentRecordCollapser {id(self)}"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _expiry_loop(self):
+        while True:
+            with self._lock:
+                records = []
+                while not records:
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._bursts:
+                        timeout = next(iter(self._bursts.values()))[0] - time.time()
+                        if timeout <= 0:
+                            records = self._expire(time.time())
+                            continue
+                    self._lock.wait(timeout)
+            for record in records:
+                self.on_expire(record)
+
+    def _expire(self, now):
+        records = []
+        bursts = self._bursts
+        while bursts:
+            key, burst = next(iter(bursts.items()))
+            if burst[0] > now:
+                break
+            del bursts[key]
+            self._append_summary(records, burst)
+        return records
+
+    @staticmethod
+    def _append_summary(records, burst):
+        _, count, first, last = burst
+        if count:
+            summary = logging.makeLogRecord(last.__dict__)
+            summary.repeat_count = count
+            summary.first_timestamp = first
+            summary.last_timestamp = last.created
+            records.append(summary)
+
+
 class FluentHandler(logging.Handler):
     """
     Logging Handler for fluent.
+
+    :param sampling_rules: optional iterable of :class:`fluent.sampling.SamplingRule`
+        used to drop records before they are formatted, e.g. during log storms.
+    :param collapse_window: if set, repeats of a record within this many seconds
+        are collapsed into one record with a `repeat_count`, see
+        :class:`RecordCollapser`.
+    :param collapse_max_keys: maximum number of distinct records tracked for
+        collapsing.
+    :param emit_lock: if False, `handle` does not take the handler lock around
+        `emit`. Records are then formatted and packed concurrently in the
+        logging threads, only the sender synchronizes them.
+
+    Other keyword arguments are passed to the sender. With ``prewarm=True``
+    the sender is created along with the handler, for instance by
+    `logging.config`, and connects in the background. With `flush_priority`,
+    records at or above that level are flushed right away by the sender.
     """
 
     def __init__(
@@ -191,6 +556,10 @@ class FluentHandler(logging.Handler):
         buffer_overflow_handler=None,
         msgpack_kwargs=None,
         nanosecond_precision=False,
+        sampling_rules=None,
+        collapse_window=None,
+        collapse_max_keys=1000,
+        emit_lock=True,
         **kwargs,
     ):
         self.tag = tag
@@ -203,26 +572,56 @@ class FluentHandler(logging.Handler):
         self._nanosecond_precision = nanosecond_precision
         self._kwargs = kwargs
         self._sender = None
+        self.emit_lock = emit_lock
         logging.Handler.__init__(self)
+        if sampling_rules:
+            self.sampling_filter = sampling.SamplingFilter(sampling_rules, tag=tag)
+            self.addFilter(self.sampling_filter)
+        else:
+            self.sampling_filter = None
+        if collapse_window:
+            self._collapser = RecordCollapser(
+                collapse_window, collapse_max_keys, on_expire=self._emit_expired
+            )
+        else:
+            self._collapser = None
+        if kwargs.get("prewarm"):
+            # created now, to connect in the background
+            self.sender  # noqa: B018
+
+    @property
+    def sampling_drops(self):
+        """Number of records dropped by sampling so far, per rule name"""
+        if self.sampling_filter is None:
+            return {}
+        return self.sampling_filter.drop_counts
 
     def getSenderClass(self):
         return sender.FluentSender
 
     @property
     def sender(self):
-        if self._sender is None:
-            self._sender = self.getSenderInstance(
-                tag=self.tag,
-                host=self._host,
-                port=self._port,
-                timeout=self._timeout,
-                verbose=self._verbose,
-                buffer_overflow_handler=self._buffer_overflow_handler,
-                msgpack_kwargs=self._msgpack_kwargs,
-                nanosecond_precision=self._nanosecond_precision,
-                **self._kwargs,
-            )
-        return self._sender
+        _sender = self._sender
+        if _sender is None:
+            # emit may run concurrently when emit_lock is False
+            self.acquire()
+            try:
+                _sender = self._sender
+                if _sender is None:
+                    _sender = self._sender = self.getSenderInstance(
+                        tag=self.tag,
+                        host=self._host,
+                        port=self._port,
+                        timeout=self._timeout,
+                        verbose=self._verbose,
+                        buffer_overflow_handler=self._buffer_overflow_handler,
+                        msgpack_kwargs=self._msgpack_kwargs,
+                        nanosecond_precision=self._nanosecond_precision,
+                        **self._kwargs,
+                    )
+            finally:
+                self.release()
+        return _sender
 
     def getSenderInstance(
         self,
@@ -249,29 +648,86 @@ class FluentHandler(logging.Handler):
             **kwargs,
         )
 
+    def handle(self, record):
+        if self.emit_lock:
+            return super().handle(record)
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
     def emit(self, record):
+        if self._collapser is None:
+            return self._emit(record)
+        result = True
+        for collapsed in self._collapser.collapse(record):
+            result = self._emit(collapsed)
+        return result
+
+    def _emit(self, record):
         data = self.format(record)
+        repeat_count = getattr(record, "repeat_count", None)
+        if repeat_count is not None:
+            data["repeat_count"] = repeat_count
+            data["first_timestamp"] = record.first_timestamp
+            data["last_timestamp"] = record.last_timestamp
         _sender = self.sender
-        return _sender.emit_with_time(
-            None,
-            sender.EventTime(record.created)
-            if _sender.nanosecond_precision
-            else int(record.created),
+        # In nanosecond mode the sender packs the float EventTime directly
+        return self._send_record(
+            _sender,
+            record.created if _sender.nanosecond_precision else int(record.created),
             data,
+            record,
         )
 
+    def _send_record(self, _sender, timestamp, data, record):
+        if getattr(_sender, "flush_priority", None) is None:
+            return _sender.emit_with_time(None, timestamp, data)
+        # the record level decides whether the event is flushed right away
+        return _sender.emit_with_time(None, timestamp, data, priority=record.levelno)
+
+    def _emit_expired(self, record):
+        # called from the collapser's expiry thread
+        self.acquire()
+        try:
+            self._emit(record)
+        except Exception:  # noqa: BLE001 - reported like logging does
+            self.handleError(record)
+        finally:
+            self.release()
+
+    def flush(self):
+        if self._collapser is not None:
+            self.acquire()
+            try:
+                for record in self._collapser.flush():
+                    self._emit(record)
+            finally:
+                self.release()
+
     def close(self):
+        if self._collapser is not None:
+            # not under the handler lock, the expiry thread may need it
+            self._collapser.close()
         self.acquire()
         try:
             try:
-                if self._sender is not None:
-                    self._sender.close()
-                    self._sender = None
+                if self._collapser is not None:
+                    for record in self._collapser.flush():
+                        self._emit(record)
+                self._close_sender()
             finally:
                 super().close()
         finally:
             self.release()
 
+    def _close_sender(self):
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+
     def __enter__(self):
         return self
 
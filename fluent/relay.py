@@ -0,0 +1,275 @@
+import os
+import selectors
+import socket
+import threading
+import time
+
+import msgpack
+
+from fluent import sender
+
+__all__ = ["Relay"]
+
+DEFAULT_FLUSH_SIZE = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.1
+
+_ARRAY_HEADER_SIZES = {0xDC: 3, 0xDD: 5}
+
+
+class Relay:
+    """Local forwarder batching the events of many producers upstream.
+
+    Producers, typically the worker processes of a pre-fork server, send to
+    the relay's unix socket with a regular `FluentSender`::
+
+        logger = sender.FluentSender('app', host='unix:///run/fluent-relay.sock')
+
+    The relay groups the events it receives by tag and forwards them over a
+    single connection in large Forward mode frames, once `flush_size` bytes
+    are buffered or `flush_interval` seconds after the first buffered event.
+    Records are passed through without being re-encoded.
+
+    Run it in a thread of its own with `start`, or in a dedicated process by
+    calling `serve_forever` there.
+
+    :param listen: path of the unix socket to listen on, with or without a
+        ``unix://`` prefix.
+    :param host: upstream host, as for `FluentSender`.
+    :param port: upstream port.
+    :param flush_size: buffered bytes triggering a flush.
+    :param flush_interval: maximum time in seconds an event is buffered.
+    :param kwargs: passed to the upstream `FluentSender`.
+    """
+
+    def __init__(
+        self,
+        listen,
+        host="localhost",
+        port=24224,
+        flush_size=DEFAULT_FLUSH_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        **kwargs,
+    ):
+        if listen.startswith("unix://"):
+            listen = listen[len("unix://") :]
+        self.listen = listen
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.sender = sender.FluentSender(None, host=host, port=port, **kwargs)
+
+        # tag -> [number of entries, list of chunks of packed entries]
+        self._entries = {}
+        # packed messages forwarded as is (PackedForward mode)
+        self._passthrough = []
+        self._buffered = 0
+        self._flush_deadline = None
+
+        self._selector = selectors.DefaultSelector()
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(listen)
+        self._server.listen(socket.SOMAXCONN)
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._serving = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Serves in a background daemon thread"""
+        self._thread = threading.Thread(
+            target=self.serve_forever, name=f"FluentRelay {id(self)}"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._serving = True
+        try:
+            while not self._closed:
+                timeout = None
+                if self._flush_deadline is not None:
+                    timeout = max(0.0, self._flush_deadline - time.monotonic())
+                for key, _ in self._selector.select(timeout):
+                    if key.fileobj is self._server:
+                        self._accept()
+                    elif key.fileobj is self._wakeup_r:
+                        self._wakeup_r.recv(4096)
+                    else:
+                        self._read(key.fileobj, key.data)
+                if self._buffered >= self.flush_size or (
+                    self._flush_deadline is not None
+                    and time.monotonic() >= self._flush_deadline
+                ):
+                    self._flush()
+        finally:
+            self._shutdown()
+
+    def close(self):
+        """Stops serving, flushes and closes the upstream sender.
+
+        Waits for the serving loop to finish, whichever thread it runs in.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            serving = self._serving
+            if serving:
+                self._wakeup_w.send(b"\0")
+        if not serving:
+            self._shutdown()
+            return
+        self._stopped.wait()
+
+    def _flush(self):
+        # Only called from the serving loop, which owns the buffers
+        if not self._buffered:
+            return True
+        frames = []
+        for tag, (count, chunks) in self._entries.items():
+            frames.append(b"\x92")
+            frames.append(self.sender._pack_tag(tag))
+            frames.append(sender._pack_array_header(count))
+            frames.extend(chunks)
+        frames.extend(self._passthrough)
+        self._entries = {}
+        self._passthrough = []
+        self._buffered = 0
+        self._flush_deadline = None
+        return self.sender._send(b"".join(frames))
+
+    def _shutdown(self):
+        with self._lock:
+            self._closed = True
+            self._wakeup_w.close()
+        while self._accept():
+            pass
+        self._selector.unregister(self._server)
+        self._server.close()
+        # Take in what producers wrote before the relay was closed
+        while True:
+            ready = [key for key, _ in self._selector.select(0) if key.data is not None]
+            if not ready:
+                break
+            for key in ready:
+                self._read(key.fileobj, key.data)
+        for key in list(self._selector.get_map().values()):
+            self._selector.unregister(key.fileobj)
+            key.fileobj.close()
+        self._selector.close()
+        try:
+            os.unlink(self.listen)
+        except OSError:
+            pass
+        try:
+            self._flush()
+            self.sender.close()
+        finally:
+            self._stopped.set()
+
+    def _accept(self):
+        try:
+            conn, _ = self._server.accept()
+        except BlockingIOError:
+            return False
+        conn.setblocking(False)
+        self._selector.register(conn, selectors.EVENT_READ, _Connection())
+        return True
+
+    def _read(self, conn, state):
+        try:
+            data = conn.recv(65536)
+        except BlockingIOError:  # pragma: no cover
+            return
+        except OSError:
+            data = b""
+        if data:
+            try:
+                for message, raw in state.feed(data):
+                    self._add(message, raw)
+                return
+            except (ValueError, TypeError, msgpack.UnpackException):
+                # Malformed stream, only this producer is dropped
+                pass
+        self._selector.unregister(conn)
+        conn.close()
+
+    def _add(self, message, raw):
+        if (
+            not isinstance(message, list)
+            or len(message) < 2
+            or not isinstance(message[0], str)
+        ):
+            raise ValueError("not a Forward protocol message")
+        tag, body = message[0], message[1]
+
+        if isinstance(body, (bytes, str)):
+            # PackedForward mode, already batched by the producer
+            self._passthrough.append(raw)
+        else:
+            packed_tag = self.sender._pack_tag(tag)
+            # Entries are sliced out of the raw message when it was packed
+            # the way FluentSender packs it, re-encoded otherwise.
+            spliced = raw[1 : 1 + len(packed_tag)] == packed_tag
+            pack = self.sender._pack
+            if isinstance(body, list):
+                for entry in body:
+                    if not isinstance(entry, list) or len(entry) != 2:
+                        raise ValueError("malformed Forward mode entry")
+                if spliced and raw[0] == 0x92:
+                    entries_raw = raw[1 + len(packed_tag) :]
+                    header_size = _ARRAY_HEADER_SIZES.get(entries_raw[0], 1)
+                    chunks = [entries_raw[header_size:]]
+                else:
+                    chunks = [
+                        b"\x92" + pack(time) + pack(record) for time, record in body
+                    ]
+                count = len(body)
+            else:
+                if len(message) < 3:
+                    raise ValueError("Message mode requires a time and a record")
+                if spliced and raw[0] == 0x93:
+                    chunks = [b"\x92" + raw[1 + len(packed_tag) :]]
+                else:
+                    chunks = [b"\x92" + pack(body) + pack(message[2])]
+                count = 1
+            buffered = self._entries.get(tag)
+            if buffered is None:
+                buffered = self._entries[tag] = [0, []]
+            buffered[0] += count
+            buffered[1].extend(chunks)
+        self._buffered += len(raw)
+        if self._flush_deadline is None:
+            self._flush_deadline = time.monotonic() + self.flush_interval
+
+
+class _Connection:
+    """Splits a producer's stream into messages along with their raw bytes"""
+
+    def __init__(self):
+        self._unpacker = msgpack.Unpacker(
+            ext_hook=msgpack.ExtType, strict_map_key=False
+        )
+        self._buffer = bytearray()
+        # stream offset of self._buffer[0]
+        self._offset = 0
+
+    def feed(self, data):
+        self._unpacker.feed(data)
+        self._buffer += data
+        start = self._offset
+        for message in self._unpacker:
+            end = self._unpacker.tell()
+            raw = bytes(self._buffer[start - self._offset : end - self._offset])
+            yield message, raw
+            start = end
+        del self._buffer[: start - self._offset]
+        self._offset = start
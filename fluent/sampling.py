@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+__all__ = [
+    "BurstSampler",
+    "RatioSampler",
+    "SamplingFilter",
+    "SamplingRule",
+    "TokenBucketSampler",
+]
+
+
+class RatioSampler:
+    """Keeps a fixed ratio of records, evenly spread.
+
+    :param ratio: fraction of records to keep, between 0 and 1.
+    """
+
+    def __init__(self, ratio):
+        if not 0 <= ratio <= 1:
+            raise ValueError("ratio must be between 0 and 1")
+        self.ratio = ratio
+        self._credit = 0.0
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            self._credit += self.ratio
+            if self._credit >= 1:
+                self._credit -= 1
+                return True
+            return False
+
+
+class TokenBucketSampler:
+    """Keeps up to `rate` records per second, with bursts of up to `burst`.
+
+    :param rate: tokens added per second.
+    :param burst: bucket size, defaults to `rate`.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class BurstSampler:
+    """Keeps the first `first` records of every `period`, then 1 in `then_every`.
+
+    :param first: records kept unconditionally in each period.
+    :param then_every: keep one of this many records once `first` is reached,
+        0 to drop them all.
+    :param period: period length in seconds.
+    """
+
+    def __init__(self, first, then_every=0, period=1.0):
+        self.first = first
+        self.then_every = then_every
+        self.period = period
+        self._period_end = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._period_end:
+                self._period_end = now + self.period
+                self._count = 0
+            self._count += 1
+            if self._count <= self.first:
+                return True
+            if not self.then_every:
+                return False
+            return (self._count - self.first) % self.then_every == 0
+
+
+class SamplingRule:
+    """Applies `sampler` to the records matching all of the given criteria.
+
+    :param sampler: an object with a `sample()` method returning whether to
+        keep the record, such as :class:`RatioSampler`.
+    :param logger: logger name; the rule matches this logger and its children.
+    :param level: level number or name; the rule matches records of exactly
+        this level.
+    :param tag: the rule only applies to handlers with this tag.
+    :param name: name of the rule in drop counts, defaults to a description
+        of the criteria.
+    """
+
+    def __init__(self, sampler, logger=None, level=None, tag=None, name=None):
+        self.sampler = sampler
+        self.logger = logger
+        if isinstance(level, str):
+            level = logging.getLevelName(level)
+        self.level = level
+        self.tag = tag
+        if name is None:
+            criteria = []
+            if tag is not None:
+                criteria.append(f"tag={tag}")
+            if logger is not None:
+                criteria.append(f"logger={logger}")
+            if level is not None:
+                criteria.append(f"level={logging.getLevelName(level)}")
+            name = ",".join(criteria) or "*"
+        self.name = name
+        self.dropped = 0
+        self._logger_prefix = None if logger is None else logger + "."
+        self._lock = threading.Lock()
+
+    def matches(self, record):
+        if self.level is not None and record.levelno != self.level:
+            return False
+        if self.logger is not None:
+            name = record.name
+            return name == self.logger or name.startswith(self._logger_prefix)
+        return True
+
+    def sample(self):
+        if self.sampler.sample():
+            return True
+        with self._lock:
+            self.dropped += 1
+        return False
+
+
+class SamplingFilter(logging.Filter):
+    """Logging filter dropping records according to sampling rules.
+
+    The first rule matching a record decides whether it is kept; records
+    matching no rule are always kept. Being a filter, it runs before the
+    handler formats the record.
+
+    :param rules: iterable of :class:`SamplingRule`.
+    :param tag: tag of the handler the filter is attached to; rules for other
+        tags are ignored.
+    """
+
+    def __init__(self, rules, tag=None):
+        super().__init__()
+        self.rules = [rule for rule in rules if rule.tag is None or rule.tag == tag]
+
+    def filter(self, record):
+        for rule in self.rules:
+            if rule.matches(record):
+                return rule.sample()
+        return True
+
+    @property
+    def drop_counts(self):
+        """Number of records dropped so far, per rule name"""
+        counts = {}
+        for rule in self.rules:
+            counts[rule.name] = counts.get(rule.name, 0) + rule.dropped
+        return counts
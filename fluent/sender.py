@@ -1,14 +1,56 @@
+import collections
 import errno
+import os
+import select
 import socket
+import ssl
 import struct
 import threading
 import time
 import traceback
+import weakref
 
 import msgpack
 
 _global_sender = None
 
+# Live senders, reset in forked children
+_senders = weakref.WeakSet()
+
+# Shared transports: key -> [transport sender, number of senders using it]
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    global _transports_lock
+    _transports_lock = threading.Lock()
+    for sender in list(_senders):
+        sender._after_fork()
+
+
+def _acquire_transport(sender, key):
+    with _transports_lock:
+        entry = _transports.get(key)
+        if entry is None:
+            entry = _transports[key] = [sender._make_transport(), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _release_transport(key):
+    with _transports_lock:
+        entry = _transports[key]
+        entry[1] -= 1
+        if entry[1]:
+            return
+        del _transports[key]
+    entry[0].close()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 def _set_global_sender(sender):  # pragma: no cover
     """[For testing] Function to set global sender directly"""
@@ -29,21 +71,209 @@ def close():  # pragma: no cover
     get_global_sender().close()
 
 
+_EVENT_TIME = struct.Struct(">II")
+# EventTime packed as msgpack fixext 8 (0xd7) with ext type 0
+_PACKED_EVENT_TIME = struct.Struct(">BBII")
+_PACKED_UINT32 = struct.Struct(">BI")
+_PACKED_UINT16 = struct.Struct(">BH")
+
+_TAG_CACHE_SIZE = 256
+
+DEFAULT_FRAME_SIZE = 64 * 1024
+
+# Appended to the strings cut by the 'truncate' oversize strategy
+TRUNCATION_MARKER = "...[truncated]"
+_OVERSIZE_STRATEGIES = ("truncate", "drop_field", "reject")
+# the marker and the largest msgpack str or bin header
+_TRUNCATED_MIN_SIZE = 5 + len(TRUNCATION_MARKER)
+
+# nonblocking mode: delays between failed connection attempts
+_RECONNECT_MIN_DELAY = 0.05
+_RECONNECT_MAX_DELAY = 1.0
+
+# Linux only, 0 elsewhere
+_MSG_MORE = getattr(socket, "MSG_MORE", 0)
+# macOS names the idle time option TCP_KEEPALIVE
+_TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+
+
 class EventTime(msgpack.ExtType):
+    __slots__ = ()
+
     def __new__(cls, timestamp, nanoseconds=None):
         seconds = int(timestamp)
         if nanoseconds is None:
             nanoseconds = int(timestamp % 1 * 10**9)
-        return super().__new__(
-            cls,
-            code=0,
-            data=struct.pack(">II", seconds, nanoseconds),
-        )
+        # code and data are always valid here, skip ExtType.__new__ checks
+        return tuple.__new__(cls, (0, _EVENT_TIME.pack(seconds, nanoseconds)))
 
     @classmethod
     def from_unix_nano(cls, unix_nano):
         seconds, nanos = divmod(unix_nano, 10**9)
-        return cls(seconds, nanos)
+        return tuple.__new__(cls, (0, _EVENT_TIME.pack(seconds, nanos)))
+
+
+def _pack_unix_nano(unix_nano):
+    seconds, nanos = divmod(unix_nano, 10**9)
+    return _PACKED_EVENT_TIME.pack(0xD7, 0, seconds, nanos)
+
+
+def _pack_seconds(seconds):
+    if 0 <= seconds <= 0xFFFFFFFF:
+        return _PACKED_UINT32.pack(0xCE, seconds)
+    return msgpack.packb(seconds)
+
+
+class _EventClock:
+    """Reads the wall clock for every event"""
+
+    def packed_now(self, nanosecond_precision):
+        if nanosecond_precision:
+            return _pack_unix_nano(time.time_ns())
+        return _pack_seconds(int(time.time()))
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        pass
+
+
+class _MonotonicClock(_EventClock):
+    """Wall clock anchored once, then advanced by the monotonic clock.
+
+    Timestamps never go backwards when the system clock is stepped.
+    """
+
+    def __init__(self):
+        self._anchor = time.time_ns() - time.monotonic_ns()
+
+    def packed_now(self, nanosecond_precision):
+        unix_nano = self._anchor + time.monotonic_ns()
+        if nanosecond_precision:
+            return _pack_unix_nano(unix_nano)
+        return _pack_seconds(unix_nano // 10**9)
+
+
+class _CachedClock(_EventClock):
+    """Pre-packed timestamps refreshed by a background thread.
+
+    Events emitted within the same `resolution` interval share a timestamp.
+    """
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self._stopped = threading.Event()
+        self._start()
+
+    def packed_now(self, nanosecond_precision):
+        return self._packed[nanosecond_precision]
+
+    def close(self):
+        self._stopped.set()
+
+    def after_fork(self):
+        # the refresh thread does not survive fork
+        if not self._stopped.is_set():
+            self._stopped = threading.Event()
+            self._start()
+
+    def _start(self):
+        self._refresh()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name=f"FluentSenderClock {id(self)}"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _refresh(self):
+        unix_nano = time.time_ns()
+        # Replaced as a whole so that readers never see a torn pair
+        self._packed = (
+            _pack_seconds(unix_nano // 10**9),
+            _pack_unix_nano(unix_nano),
+        )
+
+    def _refresh_loop(self):
+        while not self._stopped.wait(self.resolution):
+            self._refresh()
+
+
+def _make_clock(timestamp_source, timestamp_resolution):
+    if timestamp_source == "event":
+        return _EventClock()
+    if timestamp_source == "cached":
+        return _CachedClock(timestamp_resolution)
+    if timestamp_source == "monotonic":
+        return _MonotonicClock()
+    raise ValueError(f"unknown timestamp_source: {timestamp_source!r}")
+
+
+def _wait_writable(sock, timeout):
+    """Waits up to `timeout` seconds for `sock` to be writable.
+
+    select() fails on file descriptors from FD_SETSIZE (1024) on, poll() is
+    used where available.
+    """
+    if not hasattr(select, "poll"):  # pragma: no cover
+        _, writable, _ = select.select((), (sock,), (), timeout)
+        return bool(writable)
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT)
+    return bool(poller.poll(max(0.0, timeout) * 1000))
+
+
+class _Resolver:
+    """Looks up the IPv4 address of a host name in a background thread"""
+
+    def __init__(self, host, port):
+        self.address = None
+        self.error = None
+        self.done = threading.Event()
+        thread = threading.Thread(
+            target=self._resolve, args=(host, port), name=f"FluentSenderResolver {host}"
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _resolve(self, host, port):
+        try:
+            self.address = socket.getaddrinfo(
+                host, port, socket.AF_INET, socket.SOCK_STREAM
+            )[0][4]
+        except OSError as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+def _pack_array_header(n):
+    if n <= 0x0F:
+        return bytes((0x90 | n,))
+    if n <= 0xFFFF:
+        return _PACKED_UINT16.pack(0xDC, n)
+    return _PACKED_UINT32.pack(0xDD, n)
+
+
+def _check_raw_record(record_bytes):
+    # Only the leading map header is checked, the record is not parsed
+    if not record_bytes or not (
+        0x80 <= record_bytes[0] <= 0x8F or record_bytes[0] in (0xDE, 0xDF)
+    ):
+        raise ValueError("record_bytes must be a msgpack encoded map")
+
+
+def _truncate(value, size):
+    """Cuts a str or bytes to `size` encoded bytes and appends the marker"""
+    if isinstance(value, str):
+        return value.encode()[:size].decode(errors="ignore") + TRUNCATION_MARKER
+    return value[:size] + TRUNCATION_MARKER.encode()
+
+
+def _unpack_ext(code, data):
+    if code == 0:
+        return tuple.__new__(EventTime, (code, data))
+    return msgpack.ExtType(code, data)
 
 
 class FluentSender:
@@ -60,9 +290,78 @@ class FluentSender:
         msgpack_kwargs=None,
         *,
         forward_packet_error=True,
+        timestamp_source="event",
+        timestamp_resolution=0.001,
+        nonblocking=False,
+        tcp_nodelay=True,
+        send_buffer_size=None,
+        keepalive=False,
+        keepalive_idle=None,
+        keepalive_interval=None,
+        keepalive_count=None,
+        cork=False,
+        ssl_context=None,
+        server_hostname=None,
+        prewarm=False,
+        shared_transport=False,
+        flush_priority=None,
+        max_record_size=None,
+        max_field_size=None,
+        oversize_strategy="truncate",
         **kwargs,
     ):
         """
+        :param timestamp_source: how `emit` timestamps events. 'event' reads the
+            clock for every event, 'cached' reuses a timestamp refreshed every
+            `timestamp_resolution` seconds by a background thread, 'monotonic'
+            anchors the wall clock once and advances it with the monotonic clock.
+        :param timestamp_resolution: refresh interval in seconds of the 'cached'
+            timestamp source.
+        :param nonblocking: if True, `emit` never waits for the socket to become
+            writable. Whatever can't be written at once stays buffered and is
+            written by later emits, or by `close` within `timeout` seconds.
+            The connection is established in the background as well, with
+            host names looked up in a background thread, failed attempts are
+            retried with exponential backoff.
+        :param tcp_nodelay: disables Nagle's algorithm on TCP connections.
+        :param send_buffer_size: size in bytes of the socket send buffer
+            (SO_SNDBUF), for TCP and unix sockets. The OS default if None.
+        :param keepalive: enables TCP keepalive probes on idle connections.
+        :param keepalive_idle: idle time in seconds before the first probe.
+        :param keepalive_interval: time in seconds between probes.
+        :param keepalive_count: unanswered probes before the connection is
+            considered dead.
+        :param cork: lets the asynchronous sender coalesce the events it has
+            queued into full TCP segments (MSG_MORE, Linux only).
+        :param ssl_context: an `ssl.SSLContext` to connect over TLS with. The
+            TLS session is reused when reconnecting, skipping the full
+            handshake if the server allows it. Not supported in nonblocking
+            mode.
+        :param server_hostname: host name the server certificate is checked
+            against, `host` by default for TCP connections.
+        :param prewarm: if True, connects in a background thread right away,
+            retrying with exponential backoff until it succeeds, so that the
+            first event does not wait for the connection. See `wait_ready`.
+        :param shared_transport: if True, the sender shares its connection and
+            buffer (and queue and thread for the asynchronous sender) with the
+            other senders of the same class created with this option for the
+            same host, port and transport options, whatever their tag.
+        :param flush_priority: events emitted with a priority at or above it
+            are written right away, along with everything buffered or queued
+            before them: in nonblocking mode `emit` waits up to `timeout` for
+            them to be written, the asynchronous sender neither holds them back
+            in a batch nor corks them.
+        :param max_record_size: largest packed size in bytes of a record.
+            Keep it well below `bufmax`, a packet over `bufmax` that can't be
+            sent discards the whole buffer.
+        :param max_field_size: largest packed size in bytes of a top-level
+            field of a record.
+        :param oversize_strategy: what is done with a record over one of the
+            limits. 'truncate' cuts the strings and bytes over the limits,
+            appending `TRUNCATION_MARKER`, and drops the other fields over
+            them, largest first. 'drop_field' drops them. 'reject' does not
+            send the record: `emit` returns False and sets `last_error`.
+            A record that still doesn't fit is rejected. See `oversize_stats`.
         :param kwargs: This kwargs argument is not used in __init__. This will be removed in the next major version.
         """
         self.tag = tag
@@ -75,37 +374,320 @@ class FluentSender:
         self.nanosecond_precision = nanosecond_precision
         self.forward_packet_error = forward_packet_error
         self.msgpack_kwargs = {} if msgpack_kwargs is None else msgpack_kwargs
+        self.timestamp_source = timestamp_source
+        self.nonblocking = nonblocking
+        self.tcp_nodelay = tcp_nodelay
+        self.send_buffer_size = send_buffer_size
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.cork = cork
+        self.flush_priority = flush_priority
+        if oversize_strategy not in _OVERSIZE_STRATEGIES:
+            raise ValueError(f"unknown oversize_strategy: {oversize_strategy!r}")
+        self.max_record_size = max_record_size
+        self.max_field_size = max_field_size
+        self.oversize_strategy = oversize_strategy
+        # records up to it fit both limits and are not inspected
+        limits = [n for n in (max_record_size, max_field_size) if n is not None]
+        self._size_limit = min(limits) if limits else None
+        self._oversize = dict.fromkeys(
+            ("truncated_fields", "dropped_fields", "rejected_records"), 0
+        )
+        self._oversize_lock = threading.Lock()
+        if ssl_context is not None and nonblocking:
+            raise ValueError("ssl_context is not supported in nonblocking mode")
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self._clock = _make_clock(timestamp_source, timestamp_resolution)
+        # stops the clock's refresh thread, if any, when the sender is
+        # garbage collected without being closed
+        weakref.finalize(self, self._clock.close)
 
         self.socket = None
         self.pendings = None
         self.lock = threading.Lock()
         self._closed = False
         self._last_error_threadlocal = threading.local()
+        self._packer_threadlocal = threading.local()
+        self._packed_tags = {}
+        # nonblocking mode: bytes of pendings already written to the socket
+        # and lengths of the frames in pendings
+        self._pendings_sent = 0
+        self._pendings_frames = collections.deque()
+        # nonblocking mode: socket being connected and reconnect backoff
+        self._connecting = None
+        self._reconnect_at = 0.0
+        self._reconnect_delay = _RECONNECT_MIN_DELAY
+        # nonblocking mode: address of host and its pending lookup
+        self._address = None
+        self._resolver = None
+        # TLS session of the last connection, resumed by the next one
+        self._tls_session = None
+        # set once connected
+        self._ready = threading.Event()
+        self.prewarm = prewarm
+        # connection made by the prewarm thread, taken over by the first send
+        self._prewarmed = None
+        self._prewarm_lock = threading.Lock()
+        self._prewarm_stopped = threading.Event()
+        # sender writing the events of this one, if the transport is shared
+        self._transport = None
+        if shared_transport:
+            key = self._transport_key()
+            self._transport = _acquire_transport(self, key)
+            self._transport_finalizer = weakref.finalize(self, _release_transport, key)
+            # errors are recorded by the transport
+            self._last_error_threadlocal = self._transport._last_error_threadlocal
+        elif prewarm:
+            self._start_prewarm()
+        _senders.add(self)
 
-    def emit(self, label, data):
-        if self.nanosecond_precision:
-            cur_time = EventTime.from_unix_nano(time.time_ns())
-        else:
-            cur_time = int(time.time())
-        return self.emit_with_time(label, cur_time, data)
+    def emit(self, label, data, *, priority=None):
+        """
+        :param priority: optional event priority, on the scale of logging levels.
+            Used by the asynchronous sender to order and shed queued events,
+            and to flush events at or above `flush_priority`.
+        """
+        packed_time = self._clock.packed_now(self.nanosecond_precision)
+        return self._emit_packed_time(label, packed_time, data, priority)
 
-    def emit_with_time(self, label, timestamp, data):
-        try:
-            bytes_ = self._make_packet(label, timestamp, data)
-        except Exception as e:
-            if not self.forward_packet_error:
-                raise
-            self.last_error = e
-            bytes_ = self._make_packet(
-                label,
-                timestamp,
-                {
-                    "level": "CRITICAL",
-                    "message": "Can't output to log",
-                    "traceback": traceback.format_exc(),
-                },
+    def emit_with_time(self, label, timestamp, data, *, priority=None):
+        return self._emit_packed_time(
+            label, self._pack_timestamp(timestamp), data, priority
+        )
+
+    def emit_many(self, label, events, *, priority=None):
+        """Sends `(timestamp, data)` pairs under one tag as a single Forward frame.
+
+        A timestamp of None stands for the current time. Returns whether the
+        whole batch was sent (or queued).
+        """
+        tag = self._make_tag(label)
+        packed_now = self._clock.packed_now(self.nanosecond_precision)
+        entries = [
+            self._make_entry(
+                tag,
+                packed_now if timestamp is None else self._pack_timestamp(timestamp),
+                data,
+            )
+            for timestamp, data in events
+        ]
+        return self._send_entries(tag, entries, priority)
+
+    def emit_batch(self, events, *, priority=None):
+        """Sends `(label, timestamp, data)` triples in one write.
+
+        Events are grouped into one Forward frame per tag, keeping their order
+        within a tag. A timestamp of None stands for the current time.
+        Returns whether the whole batch was sent (or queued).
+        """
+        packed_now = self._clock.packed_now(self.nanosecond_precision)
+        entries_by_tag = {}
+        complete = True
+        for label, timestamp, data in events:
+            tag = self._make_tag(label)
+            entry = self._make_entry(
+                tag,
+                packed_now if timestamp is None else self._pack_timestamp(timestamp),
+                data,
             )
-        return self._send(bytes_)
+            if entry is None:
+                complete = False
+                continue
+            entries = entries_by_tag.get(tag)
+            if entries is None:
+                entries = entries_by_tag[tag] = []
+            entries.append(entry)
+        if not entries_by_tag:
+            return complete
+        sent = self._send_with_priority(
+            b"".join(
+                self._make_forward(tag, entries)
+                for tag, entries in entries_by_tag.items()
+            ),
+            priority,
+        )
+        return sent and complete
+
+    def emit_raw(self, label, timestamp, record_bytes, *, priority=None):
+        """Sends a record that is already packed as a msgpack map.
+
+        `record_bytes` is spliced into the packet as is, without being decoded
+        and re-encoded. A timestamp of None stands for the current time.
+        """
+        _check_raw_record(record_bytes)
+        record_bytes = self._limit_raw_record(record_bytes)
+        if record_bytes is None:
+            return False
+        tag = self._make_tag(label)
+        if timestamp is None:
+            packed_time = self._clock.packed_now(self.nanosecond_precision)
+        else:
+            packed_time = self._pack_timestamp(timestamp)
+        if self.verbose:
+            self._print_packed(tag, packed_time, record_bytes)
+        return self._send_with_priority(
+            b"\x93" + self._pack_tag(tag) + packed_time + record_bytes, priority
+        )
+
+    def emit_raw_many(self, label, events, *, priority=None):
+        """Like `emit_many`, for `(timestamp, record_bytes)` pairs of packed maps"""
+        tag = self._make_tag(label)
+        packed_now = self._clock.packed_now(self.nanosecond_precision)
+        entries = []
+        for timestamp, record_bytes in events:
+            _check_raw_record(record_bytes)
+            record_bytes = self._limit_raw_record(record_bytes)
+            if record_bytes is None:
+                entries.append(None)
+                continue
+            if timestamp is None:
+                packed_time = packed_now
+            else:
+                packed_time = self._pack_timestamp(timestamp)
+            if self.verbose:
+                self._print_packed(tag, packed_time, record_bytes)
+            entries.append(b"\x92" + packed_time + record_bytes)
+        return self._send_entries(tag, entries, priority)
+
+    def emit_stream(
+        self,
+        label,
+        events,
+        frame_size=DEFAULT_FRAME_SIZE,
+        progress=None,
+        timeout=None,
+    ):
+        """Sends a possibly unbounded iterable of `(timestamp, data)` pairs.
+
+        Events are pulled lazily and packed into Forward frames of about
+        `frame_size` bytes, so memory use does not depend on the input size.
+        While a frame cannot be sent (the connection is down or the queue is
+        full) iteration is paused until it goes through.
+
+        :param progress: optional callable, called after each frame with the
+            total number of events and bytes sent so far.
+        :param timeout: seconds to wait for a stalled frame before giving up,
+            None to wait until the sender is closed.
+        :return: the number of events sent.
+        """
+        tag = self._make_tag(label)
+        sent_events = sent_bytes = 0
+        entries = []
+        frame_bytes = 0
+        events = iter(events)
+        while True:
+            for timestamp, data in events:
+                if timestamp is None:
+                    packed_time = self._clock.packed_now(self.nanosecond_precision)
+                else:
+                    packed_time = self._pack_timestamp(timestamp)
+                entry = self._make_entry(tag, packed_time, data)
+                if entry is None:
+                    # rejected by oversize_strategy
+                    continue
+                entries.append(entry)
+                frame_bytes += len(entry)
+                if frame_bytes >= frame_size:
+                    break
+            if not entries:
+                return sent_events
+            frame = self._make_forward(tag, entries)
+            if self._transport is not None:
+                if self._closed:
+                    return sent_events
+                sent = self._transport._send_waiting(frame, timeout)
+            else:
+                sent = self._send_waiting(frame, timeout)
+            if not sent:
+                return sent_events
+            sent_events += len(entries)
+            sent_bytes += len(frame)
+            entries = []
+            frame_bytes = 0
+            if progress is not None:
+                progress(sent_events, sent_bytes)
+
+    def _send_entries(self, tag, entries, priority):
+        """Sends Forward mode entries as one frame, skipping rejected ones.
+
+        Returns whether all of them were sent (or queued).
+        """
+        complete = None not in entries
+        if not complete:
+            entries = [entry for entry in entries if entry is not None]
+        if not entries:
+            return complete
+        sent = self._send_with_priority(self._make_forward(tag, entries), priority)
+        return sent and complete
+
+    def _send_waiting(self, bytes_, timeout):
+        """Sends `bytes_`, waiting up to `timeout` for it to leave the buffer"""
+        with self.lock:
+            if self._closed:
+                return False
+            if self._send_internal(bytes_) and not self.pendings:
+                return True
+            if not (self.pendings and self.pendings.endswith(bytes_)):
+                # the buffer overflowed, bytes_ went to the overflow handler
+                return False
+        return self._drain(timeout)
+
+    def flush(self, timeout=None):
+        """Waits until the events emitted so far are written to the socket.
+
+        Buffered events are retried with backoff meanwhile, for at most
+        `timeout` seconds if given. Returns whether they were all written.
+        The connection is kept open.
+        """
+        if self._transport is not None:
+            return self._transport.flush(timeout)
+        return self._drain(timeout)
+
+    def _drain(self, timeout):
+        """Retries sending pendings with backoff until the buffer is empty"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            with self.lock:
+                if self._closed:
+                    return False
+                unsent = len(self.pendings or b"") - self._pendings_sent
+                if self.pendings and not self._send_internal(b"") and not self.pendings:
+                    # the buffer overflowed, its content went to the overflow
+                    # handler
+                    return False
+                if not self.pendings:
+                    return True
+                if len(self.pendings) - self._pendings_sent < unsent:
+                    # partly written in nonblocking mode, keep going
+                    delay = 0.05
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def _emit_packed_time(self, label, packed_time, data, priority=None):
+        packet = self._make_packet(label, packed_time, data)
+        if packet is None:
+            return False
+        return self._send_with_priority(packet, priority)
+
+    def _send_with_priority(self, bytes_, priority):
+        if self._transport is not None:
+            if self._closed:
+                return False
+            return self._transport._send_with_priority(bytes_, priority)
+        # Subclasses may override _send(bytes_) without the priority argument,
+        # only pass it when one was given
+        if priority is None:
+            return self._send(bytes_)
+        return self._send(bytes_, priority)
 
     @property
     def last_error(self):
@@ -119,46 +701,328 @@ class FluentSender:
         if hasattr(self._last_error_threadlocal, "exception"):
             delattr(self._last_error_threadlocal, "exception")
 
+    @property
+    def oversize_stats(self):
+        """Fields truncated or dropped and records rejected over the size
+        limits, see `max_record_size` and `max_field_size`.
+        """
+        with self._oversize_lock:
+            return dict(self._oversize)
+
+    def wait_ready(self, timeout=None):
+        """Waits up to `timeout` seconds for the sender to be connected.
+
+        Returns whether it has connected, by prewarming or sending.
+        """
+        if self._transport is not None:
+            return self._transport.wait_ready(timeout)
+        return self._ready.wait(timeout)
+
     def close(self):
         with self.lock:
             if self._closed:
                 return
             self._closed = True
+            self._clock.close()
+            if self._transport is not None:
+                self._transport_finalizer()
+                return
             if self.pendings:
-                try:
-                    self._send_data(self.pendings)
-                except Exception:
-                    self._call_buffer_overflow_handler(self.pendings)
+                if self.nonblocking:
+                    if not self._flush_nonblocking(time.monotonic() + self.timeout):
+                        self._call_buffer_overflow_handler(self.pendings)
+                else:
+                    try:
+                        self._send_data(self.pendings)
+                    except Exception:
+                        self._call_buffer_overflow_handler(self.pendings)
 
-            self._close()
+            self._stop_prewarm()
+            self._close(linger=True)
             self.pendings = None
 
-    def _make_packet(self, label, timestamp, data):
+    def _after_fork(self):
+        """Resets the state inherited by a forked child.
+
+        The lock may have been held by a thread that doesn't exist in the
+        child, the connection is the parent's and pending events are the
+        parent's to send.
+        """
+        self.lock = threading.Lock()
+        sock = self.socket
+        self.socket = None
+        if sock:
+            # not shutdown(), that would end the parent's connection as well
+            try:
+                sock.close()
+            except OSError:  # pragma: no cover
+                pass
+        self.pendings = None
+        self._pendings_sent = 0
+        self._pendings_frames.clear()
+        if self._connecting is not None:
+            self._connecting.close()
+            self._connecting = None
+        self._reconnect_at = 0.0
+        self._reconnect_delay = _RECONNECT_MIN_DELAY
+        # the lookup thread is the parent's
+        self._resolver = None
+        self._packer_threadlocal = threading.local()
+        self._oversize_lock = threading.Lock()
+        self._clock.after_fork()
+        # the prewarm thread and its connection are the parent's as well
+        self._ready = threading.Event()
+        self._prewarm_lock = threading.Lock()
+        prewarmed = self._prewarmed
+        self._prewarmed = None
+        if prewarmed is not None:
+            prewarmed.close()
+        if self.prewarm and not self._prewarm_stopped.is_set():
+            self._prewarm_stopped = threading.Event()
+            self._start_prewarm()
+
+    def _transport_options(self):
+        """Constructor arguments of the transport shared by this sender"""
+        return {
+            "bufmax": self.bufmax,
+            "timeout": self.timeout,
+            "buffer_overflow_handler": self.buffer_overflow_handler,
+            "nonblocking": self.nonblocking,
+            "tcp_nodelay": self.tcp_nodelay,
+            "send_buffer_size": self.send_buffer_size,
+            "keepalive": self.keepalive,
+            "keepalive_idle": self.keepalive_idle,
+            "keepalive_interval": self.keepalive_interval,
+            "keepalive_count": self.keepalive_count,
+            "cork": self.cork,
+            "ssl_context": self.ssl_context,
+            "server_hostname": self.server_hostname,
+            "prewarm": self.prewarm,
+            "flush_priority": self.flush_priority,
+        }
+
+    def _transport_key(self):
+        options = []
+        for name, value in sorted(self._transport_options().items()):
+            if isinstance(value, dict):
+                value = tuple(sorted(value.items()))
+            options.append((name, value))
+        return (type(self), self.host, self.port, tuple(options))
+
+    def _make_transport(self):
+        return type(self)(
+            None, host=self.host, port=self.port, **self._transport_options()
+        )
+
+    def _make_tag(self, label):
         if label:
-            tag = f"{self.tag}.{label}" if self.tag else label
-        else:
-            tag = self.tag
-        if self.nanosecond_precision and isinstance(timestamp, float):
-            timestamp = EventTime(timestamp)
-        packet = (tag, timestamp, data)
+            return f"{self.tag}.{label}" if self.tag else label
+        return self.tag
+
+    def _make_packet(self, label, packed_time, data):
+        """Builds a Message mode packet from an already packed timestamp.
+
+        The array header, tag and timestamp are spliced in front of the packed
+        record so that only the record goes through the packer. Returns None
+        if the record is rejected by `oversize_strategy`.
+        """
+        tag = self._make_tag(label)
+        if self.verbose:
+            print((tag, msgpack.unpackb(packed_time, ext_hook=_unpack_ext), data))
+        record = self._pack_record(data)
+        if record is None:
+            return None
+        return b"\x93" + self._pack_tag(tag) + packed_time + record
+
+    @staticmethod
+    def _print_packed(tag, packed_time, record_bytes):
+        print(
+            (
+                tag,
+                msgpack.unpackb(packed_time, ext_hook=_unpack_ext),
+                msgpack.unpackb(record_bytes),
+            )
+        )
+
+    def _make_entry(self, tag, packed_time, data):
+        """Builds a packed `[time, record]` Forward mode entry, None if rejected"""
         if self.verbose:
-            print(packet)
-        return msgpack.packb(packet, **self.msgpack_kwargs)
+            print((tag, msgpack.unpackb(packed_time, ext_hook=_unpack_ext), data))
+        record = self._pack_record(data)
+        if record is None:
+            return None
+        return b"\x92" + packed_time + record
+
+    def _make_forward(self, tag, entries):
+        """Builds a Forward mode frame from packed entries"""
+        return b"".join(
+            (b"\x92", self._pack_tag(tag), _pack_array_header(len(entries)), *entries)
+        )
+
+    def _pack_record(self, data):
+        try:
+            packed = self._pack(data)
+        except Exception as e:
+            if not self.forward_packet_error:
+                raise
+            self.last_error = e
+            return self._pack(
+                {
+                    "level": "CRITICAL",
+                    "message": "Can't output to log",
+                    "traceback": traceback.format_exc(),
+                }
+            )
+        if self._size_limit is not None and len(packed) > self._size_limit:
+            return self._limit_record(data, packed)
+        return packed
+
+    def _limit_raw_record(self, record_bytes):
+        if self._size_limit is None or len(record_bytes) <= self._size_limit:
+            return record_bytes
+        try:
+            data = msgpack.unpackb(
+                record_bytes, ext_hook=_unpack_ext, strict_map_key=False
+            )
+        except (ValueError, TypeError, msgpack.UnpackException):
+            # can't be cut down, such as a map with non-hashable keys
+            self._reject_record(len(record_bytes))
+            return None
+        return self._limit_record(data, record_bytes)
+
+    def _limit_record(self, data, packed):
+        """Applies `oversize_strategy` to a record that may be over the limits.
+
+        Only called for records over the smallest limit, the fields are then
+        packed one by one to be measured. Returns the packed record, None if
+        it is rejected.
+        """
+        record_limit = self.max_record_size
+        field_limit = self.max_field_size
+        if not isinstance(data, dict):
+            if record_limit is not None and len(packed) > record_limit:
+                self._reject_record(len(packed))
+                return None
+            return packed
+        sizes = {key: len(self._pack(value)) for key, value in data.items()}
+        over = field_limit is not None and any(
+            size > field_limit for size in sizes.values()
+        )
+        if record_limit is not None and len(packed) > record_limit:
+            over = True
+        if not over:
+            return packed
+        if self.oversize_strategy == "reject":
+            self._reject_record(len(packed))
+            return None
+
+        record = dict(data)
+        truncated = set()
+        dropped = 0
+
+        def shrink(key, room):
+            nonlocal dropped
+            value = record[key]
+            if (
+                self.oversize_strategy == "truncate"
+                and _TRUNCATED_MIN_SIZE <= room < sizes[key]
+                and isinstance(value, (str, bytes))
+            ):
+                record[key] = _truncate(value, room - _TRUNCATED_MIN_SIZE)
+                sizes[key] = len(self._pack(record[key]))
+                truncated.add(key)
+                return
+            del record[key]
+            del sizes[key]
+            truncated.discard(key)
+            dropped += 1
+
+        if field_limit is not None:
+            for key, size in list(sizes.items()):
+                if size > field_limit:
+                    shrink(key, field_limit)
+        packed = self._pack(record)
+        if record_limit is not None:
+            for key in sorted(sizes, key=sizes.get, reverse=True):
+                excess = len(packed) - record_limit
+                if excess <= 0:
+                    break
+                # strings are cut down to the marker before the next field
+                shrink(key, max(sizes[key] - excess, _TRUNCATED_MIN_SIZE))
+                packed = self._pack(record)
+            if len(packed) > record_limit:
+                self._reject_record(len(packed))
+                return None
+
+        with self._oversize_lock:
+            self._oversize["truncated_fields"] += len(truncated)
+            self._oversize["dropped_fields"] += dropped
+        return packed
+
+    def _reject_record(self, size):
+        self.last_error = ValueError(
+            f"record of {size} bytes exceeds max_record_size or max_field_size"
+        )
+        with self._oversize_lock:
+            self._oversize["rejected_records"] += 1
+
+    def _pack(self, obj):
+        # msgpack.packb() builds a new Packer per call, reuse one per thread
+        try:
+            packer = self._packer_threadlocal.packer
+        except AttributeError:
+            packer = self._packer_threadlocal.packer = msgpack.Packer(
+                **self.msgpack_kwargs
+            )
+        return packer.pack(obj)
+
+    def _pack_tag(self, tag):
+        packed = self._packed_tags.get(tag)
+        if packed is None:
+            if len(self._packed_tags) >= _TAG_CACHE_SIZE:
+                self._packed_tags.clear()
+            packed = self._packed_tags[tag] = self._pack(tag)
+        return packed
 
-    def _send(self, bytes_):
+    def _pack_timestamp(self, timestamp):
+        cls = timestamp.__class__
+        if cls is int:
+            return _pack_seconds(timestamp)
+        if cls is EventTime:
+            return b"\xd7\x00" + timestamp.data
+        if cls is float and self.nanosecond_precision:
+            seconds = int(timestamp)
+            return _PACKED_EVENT_TIME.pack(0xD7, 0, seconds, int(timestamp % 1 * 10**9))
+        return self._pack(timestamp)
+
+    def _send(self, bytes_, priority=None):
         with self.lock:
             if self._closed:
                 return False
+            if self.nonblocking and self._is_urgent(priority):
+                return self._send_internal(bytes_) and self._flush_nonblocking(
+                    time.monotonic() + self.timeout
+                )
             return self._send_internal(bytes_)
 
-    def _send_internal(self, bytes_):
+    def _is_urgent(self, priority):
+        return (
+            self.flush_priority is not None
+            and priority is not None
+            and priority >= self.flush_priority
+        )
+
+    def _send_internal(self, bytes_, more=False):
+        if self.nonblocking:
+            return self._send_internal_nonblocking(bytes_)
+
         # buffering
         if self.pendings:
             self.pendings += bytes_
             bytes_ = self.pendings
 
         try:
-            self._send_data(bytes_)
+            self._send_data(bytes_, more)
 
             # send finished
             self.pendings = None
@@ -179,11 +1043,204 @@ class FluentSender:
 
             return False
 
+    def _send_internal_nonblocking(self, bytes_):
+        if bytes_:
+            if self.pendings:
+                self.pendings += bytes_
+            else:
+                self.pendings = bytes_
+                self._pendings_sent = 0
+                self._pendings_frames.clear()
+            self._pendings_frames.append(len(bytes_))
+
+        if not self.pendings:
+            return True
+
+        try:
+            self._send_data_nonblocking()
+            return True
+        except OSError as e:
+            self.last_error = e
+
+            # close socket, a partially written frame is sent again in full
+            # on the next connection
+            self._close()
+            self._pendings_sent = 0
+
+            return False
+        finally:
+            if self.pendings and len(self.pendings) > self.bufmax:
+                self._overflow_nonblocking()
+
+    def _send_data_nonblocking(self):
+        if not self._connect_nonblocking():
+            return
+        self._check_recv_side()
+        self.socket.settimeout(0.0)
+        try:
+            pendings = memoryview(self.pendings)
+            sent = self._pendings_sent
+            while sent < len(pendings):
+                try:
+                    n = self.socket.send(pendings[sent:])
+                except BlockingIOError:
+                    break
+                if n == 0:
+                    raise OSError(errno.EPIPE, "Broken pipe")
+                sent += n
+        finally:
+            self.socket.settimeout(self.timeout)
+
+        if sent == len(pendings):
+            self.pendings = None
+            self._pendings_sent = 0
+            self._pendings_frames.clear()
+            return
+
+        # drop the frames written completely, keep pendings frame aligned
+        frames = self._pendings_frames
+        written = 0
+        while frames[0] <= sent - written:
+            written += frames.popleft()
+        self.pendings = self.pendings[written:]
+        self._pendings_sent = sent - written
+
+    def _connect_nonblocking(self):
+        """Advances the connection without waiting, returns if it is up.
+
+        Raises OSError when an attempt fails, the next one is made after an
+        exponentially growing delay.
+        """
+        if self.socket:
+            return True
+        sock = self._take_prewarmed()
+        if sock is not None:
+            self.socket = sock
+            return True
+        sock = self._connecting
+        if sock is None:
+            if time.monotonic() < self._reconnect_at:
+                return False
+            try:
+                if self.host.startswith("unix://"):
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._configure_socket(sock)
+                    sock.setblocking(False)
+                    # unix sockets connect at once, or fail
+                    sock.connect(self.host[len("unix://") :])
+                else:
+                    address = self._resolve_nonblocking()
+                    if address is None:
+                        return False
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self._configure_socket(sock)
+                    self._configure_tcp(sock)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(address)
+                    if err not in (0, errno.EINPROGRESS):
+                        raise OSError(err, os.strerror(err))
+            except OSError:
+                if sock is not None:
+                    sock.close()
+                self._connect_failed()
+                raise
+            self._connecting = sock
+
+        if not _wait_writable(sock, 0):
+            return False
+        self._connecting = None
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            sock.close()
+            self._connect_failed()
+            raise OSError(err, os.strerror(err))
+        sock.settimeout(self.timeout)
+        self.socket = sock
+        self._reconnect_delay = _RECONNECT_MIN_DELAY
+        self._ready.set()
+        return True
+
+    def _connect_failed(self):
+        self._reconnect_at = time.monotonic() + self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, _RECONNECT_MAX_DELAY)
+        # looked up again, the host may have moved
+        self._address = None
+
+    def _resolve_nonblocking(self):
+        """Returns the address of `host`, None while it is being looked up.
+
+        getaddrinfo() can block for seconds on a name, it is called in a
+        background thread. Numeric addresses are used right away. Raises
+        OSError if the lookup failed.
+        """
+        if self._address is not None:
+            return self._address
+        resolver = self._resolver
+        if resolver is None:
+            try:
+                self._address = socket.getaddrinfo(
+                    self.host,
+                    self.port,
+                    socket.AF_INET,
+                    socket.SOCK_STREAM,
+                    0,
+                    socket.AI_NUMERICHOST,
+                )[0][4]
+                return self._address
+            except socket.gaierror:
+                pass
+            resolver = self._resolver = _Resolver(self.host, self.port)
+        if not resolver.done.is_set():
+            return None
+        self._resolver = None
+        if resolver.error is not None:
+            raise resolver.error
+        self._address = resolver.address
+        return self._address
+
+    def _overflow_nonblocking(self):
+        if self._pendings_sent:
+            # the head frame is half way on the wire and must be completed
+            head = self._pendings_frames[0]
+            if len(self.pendings) > head:
+                self._call_buffer_overflow_handler(self.pendings[head:])
+            self.pendings = self.pendings[:head]
+            self._pendings_frames.clear()
+            self._pendings_frames.append(head)
+        else:
+            self._call_buffer_overflow_handler(self.pendings)
+            self.pendings = None
+            self._pendings_frames.clear()
+
+    def _flush_nonblocking(self, deadline):
+        """Writes pendings until empty or `deadline` (monotonic) passes"""
+        while True:
+            if not self._send_internal_nonblocking(b""):
+                return False
+            if not self.pendings:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            sock = self.socket or self._connecting
+            if self._resolver is not None:
+                self._resolver.done.wait(remaining)
+            elif sock is None:
+                # waiting for the next connection attempt
+                time.sleep(
+                    max(0.0, min(remaining, self._reconnect_at - time.monotonic()))
+                )
+            else:
+                _wait_writable(sock, remaining)
+
     def _check_recv_side(self):
         try:
             self.socket.settimeout(0.0)
             try:
                 recvd = self.socket.recv(4096)
+            except ssl.SSLWantReadError:
+                # nothing but TLS records, such as session tickets
+                return
             except OSError as recv_e:
                 if recv_e.errno != errno.EWOULDBLOCK:
                     raise
@@ -194,15 +1251,21 @@ class FluentSender:
         finally:
             self.socket.settimeout(self.timeout)
 
-    def _send_data(self, bytes_):
+    def _send_data(self, bytes_, more=False):
         # reconnect if possible
         self._reconnect()
+        # more data follows right away, let the kernel hold back the last
+        # partial segment
+        flags = _MSG_MORE if more and self.cork else 0
         # send message
         bytes_to_send = len(bytes_)
         bytes_sent = 0
         self._check_recv_side()
         while bytes_sent < bytes_to_send:
-            sent = self.socket.send(bytes_[bytes_sent:])
+            if flags:
+                sent = self.socket.send(bytes_[bytes_sent:], flags)
+            else:
+                sent = self.socket.send(bytes_[bytes_sent:])
             if sent == 0:
                 raise OSError(errno.EPIPE, "Broken pipe")
             bytes_sent += sent
@@ -210,25 +1273,100 @@ class FluentSender:
 
     def _reconnect(self):
         if not self.socket:
+            sock = self._take_prewarmed()
+            if sock is None:
+                sock = self._connect()
+            self.socket = sock
+            self._ready.set()
+
+    def _connect(self):
+        try:
+            if self.host.startswith("unix://"):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                self._configure_socket(sock)
+                sock.connect(self.host[len("unix://") :])
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                self._configure_socket(sock)
+                self._configure_tcp(sock)
+                sock.connect((self.host, self.port))
+            if self.ssl_context is not None:
+                sock = self._wrap_tls(sock)
+        except Exception as e:
             try:
-                if self.host.startswith("unix://"):
-                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                    sock.settimeout(self.timeout)
-                    sock.connect(self.host[len("unix://") :])
-                else:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(self.timeout)
-                    # This might be controversial and may need to be removed
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                    sock.connect((self.host, self.port))
-            except Exception as e:
-                try:
-                    sock.close()
-                except Exception:  # pragma: no cover
-                    pass
-                raise e
+                sock.close()
+            except Exception:  # pragma: no cover
+                pass
+            raise e
+        return sock
+
+    def _start_prewarm(self):
+        thread = threading.Thread(
+            target=self._prewarm_loop, name=f"FluentSenderPrewarm {id(self)}"
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _prewarm_loop(self):
+        stopped = self._prewarm_stopped
+        delay = _RECONNECT_MIN_DELAY
+        while not stopped.is_set():
+            try:
+                sock = self._connect()
+            except OSError:
+                stopped.wait(delay)
+                delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+                continue
+            with self._prewarm_lock:
+                # not handed over if a send connected in the meantime
+                if not stopped.is_set() and self.socket is None:
+                    self._prewarmed, sock = sock, None
+            if sock is None:
+                self._ready.set()
             else:
-                self.socket = sock
+                sock.close()
+            return
+
+    def _take_prewarmed(self):
+        if self._prewarmed is None:
+            return None
+        with self._prewarm_lock:
+            sock, self._prewarmed = self._prewarmed, None
+        return sock
+
+    def _stop_prewarm(self):
+        with self._prewarm_lock:
+            self._prewarm_stopped.set()
+            sock, self._prewarmed = self._prewarmed, None
+        if sock is not None:
+            sock.close()
+
+    def _wrap_tls(self, sock):
+        server_hostname = self.server_hostname
+        if server_hostname is None and not self.host.startswith("unix://"):
+            server_hostname = self.host
+        return self.ssl_context.wrap_socket(
+            sock, server_hostname=server_hostname, session=self._tls_session
+        )
+
+    def _configure_socket(self, sock):
+        if self.send_buffer_size is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+
+    def _configure_tcp(self, sock):
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for option, value in (
+                (_TCP_KEEPIDLE, self.keepalive_idle),
+                (getattr(socket, "TCP_KEEPINTVL", None), self.keepalive_interval),
+                (getattr(socket, "TCP_KEEPCNT", None), self.keepalive_count),
+            ):
+                if option is not None and value is not None:
+                    sock.setsockopt(socket.IPPROTO_TCP, option, value)
 
     def _call_buffer_overflow_handler(self, pending_events):
         try:
@@ -238,10 +1376,15 @@ class FluentSender:
             # User should care any exception in handler
             pass
 
-    def _close(self):
+    def _close(self, linger=False):
         try:
             sock = self.socket
             if sock:
+                if self.ssl_context is not None:
+                    if sock.session is not None:
+                        self._tls_session = sock.session
+                    if linger:
+                        self._linger(sock)
                 try:
                     try:
                         sock.shutdown(socket.SHUT_RDWR)
@@ -254,6 +1397,29 @@ class FluentSender:
                         pass
         finally:
             self.socket = None
+            if self._connecting is not None:
+                self._connecting.close()
+                self._connecting = None
+
+    def _linger(self, sock):
+        """Waits up to `timeout` for the server to close the connection.
+
+        Closing a socket with unread data, such as TLS 1.3 session tickets
+        received after the last read, resets the connection and discards what
+        the server has not read yet.
+        """
+        deadline = time.monotonic() + self.timeout
+        try:
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                sock.settimeout(remaining)
+                if not sock.recv(4096):
+                    return
+        except OSError:
+            pass
 
     def __enter__(self):
         return self
@@ -3,7 +3,9 @@ try:
 except ImportError:
     from io import BytesIO
 
+import os
 import socket
+import ssl
 import threading
 
 from msgpack import Unpacker
@@ -88,3 +90,89 @@ class MockRecvServer(threading.Thread):
                 pass
 
         self.join()
+
+
+class MockDiscardServer(MockRecvServer):
+    """
+    Like MockRecvServer, counts the received data instead of keeping it,
+    without allocating memory once the connection is accepted.
+    """
+
+    def __init__(self, host="localhost", port=0):
+        self.received = 0
+        self._recv_buf = bytearray(16384)
+        super().__init__(host, port)
+
+    def run(self):
+        sock = self._sock
+
+        try:
+            try:
+                con, _ = sock.accept()
+            except OSError:
+                return
+            self._con = con
+            try:
+                while True:
+                    try:
+                        nbytes = con.recv_into(self._recv_buf)
+                    except OSError:
+                        break
+                    if not nbytes:
+                        break
+                    self.received += nbytes
+            finally:
+                con.close()
+        finally:
+            sock.close()
+
+
+CERTFILE = os.path.join(os.path.dirname(__file__), "localhost.pem")
+
+
+class MockTLSRecvServer(MockRecvServer):
+    """
+    Like MockRecvServer, over TLS with the self-signed certificate of
+    localhost.pem. Accepts `connections` connections one after the other,
+    all received data is kept in the same buffer.
+    """
+
+    def __init__(self, host="localhost", port=0, connections=1, context=None):
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(CERTFILE)
+        self.context = context
+        self.connections = connections
+        # session_reused of each connection
+        self.session_reused = []
+        super().__init__(host, port)
+
+    @staticmethod
+    def client_context():
+        return ssl.create_default_context(cafile=CERTFILE)
+
+    def run(self):
+        sock = self._sock
+
+        try:
+            for _ in range(self.connections):
+                try:
+                    con, _ = sock.accept()
+                    con = self.context.wrap_socket(con, server_side=True)
+                except OSError:
+                    return
+                self._con = con
+                self.session_reused.append(con.session_reused)
+                try:
+                    while True:
+                        try:
+                            data = con.recv(16384)
+                        except OSError:
+                            break
+                        if not data:
+                            break
+                        self._buf.write(data)
+                finally:
+                    con.close()
+        finally:
+            sock.close()
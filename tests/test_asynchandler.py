@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 import unittest
 
 try:
@@ -14,6 +16,7 @@ except ImportError:
 import fluent.asynchandler
 import fluent.handler
 from tests import mockserver
+from tests.test_sender import run_in_child
 
 
 def get_logger(name, level=logging.INFO):
@@ -22,6 +25,29 @@ def get_logger(name, level=logging.INFO):
     return logger
 
 
+def remove_handlers():
+    # Handlers left on the shared logger would lazily reconnect on later
+    # tests' records, possibly to a reused port.
+    log = logging.getLogger("fluent.test")
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+
+
+class GatedFormatter(fluent.handler.FluentRecordFormatter):
+    """Formats once the gate is open, records the formatting threads"""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.threads = []
+
+    def format(self, record):
+        self.gate.wait(5)
+        self.threads.append(threading.current_thread())
+        return super().format(record)
+
+
 class TestHandler(unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -30,6 +56,7 @@ class TestHandler(unittest.TestCase):
 
     def tearDown(self):
         self._server.close()
+        remove_handlers()
 
     def get_handler_class(self):
         # return fluent.handler.FluentHandler
@@ -57,6 +84,186 @@ class TestHandler(unittest.TestCase):
         self.assertTrue(data[0][1])
         self.assertTrue(isinstance(data[0][1], int))
 
+    def test_record_level_is_priority(self):
+        handler = self.get_handler_class()(
+            "app.follow",
+            port=self._port,
+            queue_priorities={logging.ERROR: 1 << 20, 0: 1 << 20},
+        )
+        priorities = []
+
+        with handler:
+            send = handler.sender._send
+
+            def _send(bytes_, priority=None):
+                priorities.append(priority)
+                return send(bytes_, priority)
+
+            handler.sender._send = _send
+            log = get_logger("fluent.test")
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log.addHandler(handler)
+            log.error("boom")
+            log.info("done")
+
+        data = self.get_data()
+        self.assertEqual(priorities, [logging.ERROR, logging.INFO])
+        self.assertEqual(len(data), 2)
+
+    def test_custom_sender_class(self):
+        sent = []
+
+        class Sender(fluent.asyncsender.FluentSender):
+            # _send of senders predating event priorities
+            def _send(self, bytes_):
+                sent.append(bytes_)
+                return super()._send(bytes_)
+
+        class Handler(fluent.asynchandler.FluentHandler):
+            def getSenderClass(self):
+                return Sender
+
+        with Handler("app.follow", port=self._port) as handler:
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test_custom_sender")
+            log.addHandler(handler)
+            log.error("boom")
+            log.removeHandler(handler)
+
+        self.assertEqual(len(sent), 1)
+        data = self.get_data()
+        self.assertEqual(data[0][2]["message"], "boom")
+
+    def test_defer_format(self):
+        handler = self.get_handler_class()(
+            "app.follow", port=self._port, defer_format=True
+        )
+        formatter = GatedFormatter()
+
+        with handler:
+            handler.setFormatter(formatter)
+            log = get_logger("fluent.test")
+            log.addHandler(handler)
+            event = {"from": "userA", "to": "userB"}
+            log.info(event)
+            # the record was snapshotted
+            event["to"] = "userC"
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                log.exception("failed %s", "op")
+            formatter.gate.set()
+            handler.flush()
+            self.assertEqual(len(formatter.threads), 2)
+            self.assertNotIn(threading.current_thread(), formatter.threads)
+
+        data = self.get_data()
+        self.assertEqual(data[0][2]["to"], "userB")
+        self.assertTrue(data[1][2]["message"].startswith("failed op\n"))
+        self.assertIn("ValueError: boom", data[1][2]["message"])
+
+    def test_defer_format_bounded_waits(self):
+        handler = self.get_handler_class()(
+            "app.follow",
+            port=self._port,
+            defer_format=True,
+            queue_maxsize=1,
+            timeout=0.2,
+        )
+        release = threading.Event()
+
+        def _send_data(bytes_, more=False):
+            # an unreachable collector
+            release.wait(5)
+
+        handler.sender._send_data = _send_data
+        handler.setFormatter(fluent.handler.FluentRecordFormatter())
+        log = get_logger("fluent.test")
+        log.addHandler(handler)
+        try:
+            # the format thread ends up waiting for room in the sender queue
+            for i in range(3):
+                log.info("n %d", i)
+            start = time.monotonic()
+            handler.flush()
+            self.assertLess(time.monotonic() - start, 1.0)
+            threading.Timer(0.5, release.set).start()
+            handler.close()
+            # not waited for either
+            self.assertTrue(handler._format_abandoned)
+        finally:
+            release.set()
+
+    def test_defer_format_circular(self):
+        handler = self.get_handler_class()(
+            "app.follow",
+            port=self._port,
+            defer_format=True,
+            queue_circular=True,
+            queue_maxsize=1,
+        )
+        formatter = GatedFormatter()
+
+        with handler:
+            handler.setFormatter(formatter)
+            log = get_logger("fluent.test")
+            log.addHandler(handler)
+            # the logging thread does not wait for the format thread
+            for i in range(5):
+                log.info("record %d", i)
+            formatter.gate.set()
+
+        messages = [d[2]["message"] for d in self.get_data()]
+        self.assertLessEqual(len(messages), 2)
+        self.assertEqual(messages[-1], "record 4")
+
+    def test_defer_format_fork(self):
+        handler = self.get_handler_class()(
+            "app.follow", port=self._port, defer_format=True
+        )
+        with handler:
+            parent_thread = handler._format_thread
+
+            def child():
+                thread = handler._format_thread
+                return thread is not parent_thread and thread.is_alive()
+
+            self.assertTrue(run_in_child(child))
+
+    def test_without_emit_lock(self):
+        handler = self.get_handler_class()(
+            "app.follow", port=self._port, emit_lock=False
+        )
+        with handler:
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test")
+            log.addHandler(handler)
+            handler.sender  # noqa: B018 - created before the lock is held
+
+            def log_records(i):
+                for j in range(100):
+                    log.info("record %d", i * 100 + j)
+
+            threads = [
+                threading.Thread(target=log_records, args=(i,)) for i in range(8)
+            ]
+            # records are emitted while another thread holds the handler lock
+            handler.acquire()
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(10)
+                self.assertFalse(any(thread.is_alive() for thread in threads))
+            finally:
+                handler.release()
+            log.removeHandler(handler)
+
+        data = self.get_data()
+        self.assertEqual(
+            sorted(int(d[2]["message"].split()[1]) for d in data), list(range(800))
+        )
+
     def test_custom_fmt(self):
         handler = self.get_handler_class()("app.follow", port=self._port)
 
@@ -270,6 +477,7 @@ class TestHandlerWithCircularQueue(unittest.TestCase):
 
     def tearDown(self):
         self._server.close()
+        remove_handlers()
 
     def get_handler_class(self):
         # return fluent.handler.FluentHandler
@@ -331,6 +539,7 @@ class TestHandlerWithCircularQueueHandler(unittest.TestCase):
 
     def tearDown(self):
         self._server.close()
+        remove_handlers()
 
     def get_handler_class(self):
         # return fluent.handler.FluentHandler
@@ -1,9 +1,16 @@
+import os
+import signal
+import threading
+import time
 import unittest
+from io import BytesIO
+from queue import Empty, Full
 
 import msgpack
 
 import fluent.asyncsender
 from tests import mockserver
+from tests.test_sender import run_in_child
 
 
 class TestSetup(unittest.TestCase):
@@ -113,6 +120,63 @@ class TestSender(unittest.TestCase):
         eq(data[0][1].code, 0)
         eq(data[0][1].data, b"X\xd0\x8873[\xb0*")
 
+    def test_emit_many(self):
+        with self._sender as sender:
+            self.assertTrue(
+                sender.emit_many("foo", [(1, {"bar": "baz"}), (2, {"bar": "qux"})])
+            )
+            self.assertTrue(sender.emit_batch([("foo", 3, {}), ("bar", 4, {})]))
+
+        data = self.get_data()
+        eq = self.assertEqual
+        eq(3, len(data))
+        eq(["test.foo", [[1, {"bar": "baz"}], [2, {"bar": "qux"}]]], data[0])
+        eq(["test.foo", [[3, {}]]], data[1])
+        eq(["test.bar", [[4, {}]]], data[2])
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "fork not supported")
+    def test_cork(self):
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test", port=self._server.port, cork=True, queue_maxsize=1000
+        )
+        sent = []
+        send_data = self._sender._send_data
+
+        def _send_data(bytes_, more=False):
+            sent.append(more)
+            send_data(bytes_, more)
+
+        self._sender._send_data = _send_data
+        with self._sender as sender:
+            for i in range(100):
+                sender.emit("foo", {"n": i})
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], list(range(100)))
+        self.assertEqual(len(sent), 100)
+
+    def test_fork(self):
+        with self._sender as sender:
+            sender.emit("foo", {"n": 1})
+            old_thread = sender._send_thread
+
+            def child():
+                return {
+                    "thread": sender._send_thread is not old_thread
+                    and sender._send_thread.is_alive(),
+                    "queue": sender._queue.empty(),
+                    "socket": sender.socket is None,
+                }
+
+            self.assertEqual(
+                run_in_child(child), {"thread": True, "queue": True, "socket": True}
+            )
+            sender.emit("foo", {"n": 2})
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1, 2])
+
     def test_no_last_error_on_successful_emit(self):
         with self._sender as sender:
             sender.emit("foo", {"bar": "baz"})
@@ -144,6 +208,56 @@ class TestSender(unittest.TestCase):
 
         self.assertEqual(self._sender.last_error.args[0], EXCEPTION_MSG)
 
+    def test_prewarm(self):
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test", port=self._server.port, prewarm=True
+        )
+        with self._sender as sender:
+            self.assertTrue(sender.wait_ready(3))
+            sender.emit("foo", {"bar": "baz"})
+
+        data = self.get_data()
+        self.assertEqual(data[0][2], {"bar": "baz"})
+
+    def test_shared_transport(self):
+        self._sender.close()
+        first = fluent.asyncsender.FluentSender(
+            tag="first", port=self._server.port, shared_transport=True
+        )
+        second = fluent.asyncsender.FluentSender(
+            tag="second", port=self._server.port, shared_transport=True
+        )
+        self._sender = first
+        # one queue and worker thread
+        self.assertIs(first._transport, second._transport)
+        self.assertFalse(hasattr(first, "_send_thread"))
+        for i in range(10):
+            (first if i % 2 else second).emit("foo", {"n": i})
+        first.close()
+        second.close()
+
+        data = self.get_data()
+        self.assertEqual(
+            [(d[0], d[2]["n"]) for d in data],
+            [("first.foo" if i % 2 else "second.foo", i) for i in range(10)],
+        )
+
+    def test_tls(self):
+        self.tearDown()
+        self._server = mockserver.MockTLSRecvServer("localhost")
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            ssl_context=self._server.client_context(),
+        )
+        with self._sender as sender:
+            for i in range(10):
+                sender.emit("foo", {"n": i, "message": "x" * 65536})
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], list(range(10)))
+
     def test_sender_without_flush(self):
         with self._sender as sender:
             sender._queue.put(
@@ -155,6 +269,173 @@ class TestSender(unittest.TestCase):
             sender.close(False)
             self.assertIs(sender._queue.get(False), fluent.asyncsender._TOMBSTONE)
 
+    def test_flush(self):
+        written = []
+        send_data = self._sender._send_data
+
+        def _send_data(bytes_, more=False):
+            send_data(bytes_, more)
+            written.append(bytes_)
+
+        self._sender._send_data = _send_data
+        with self._sender as sender:
+            for i in range(50):
+                sender.emit("foo", {"n": i})
+            self.assertTrue(sender.flush(5))
+            self.assertEqual(len(written), 50)
+            self.assertTrue(sender._send_thread.is_alive())
+            sender.emit("foo", {"n": 50})
+        self.assertFalse(sender.flush())
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], list(range(51)))
+
+    def test_flush_timeout(self):
+        def _send_data(bytes_, more=False):
+            raise OSError("collector down")
+
+        self._sender._send_data = _send_data
+        with self._sender as sender:
+            sender.emit("foo", {"n": 1})
+            start = time.monotonic()
+            self.assertFalse(sender.flush(0.2))
+            self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_flush_circular_overflow(self):
+        discarded = []
+        writing = threading.Event()
+        release = threading.Event()
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            queue_maxsize=3,
+            queue_circular=True,
+            queue_overflow_handler=discarded.append,
+        )
+        send_data = self._sender._send_data
+
+        def _send_data(bytes_, more=False):
+            writing.set()
+            release.wait(5)
+            send_data(bytes_, more)
+
+        self._sender._send_data = _send_data
+        flushed = []
+        with self._sender as sender:
+            sender.emit("foo", {"n": 0})
+            writing.wait(5)
+            for i in range(1, 4):
+                sender.emit("foo", {"n": i})
+            flusher = threading.Thread(target=lambda: flushed.append(sender.flush(3)))
+            flusher.start()
+            while len(sender._queue.queue) < 4:
+                time.sleep(0.01)
+            # the barrier is not discarded nor counted
+            for i in range(4, 9):
+                sender.emit("foo", {"n": i})
+            self.assertEqual(len(discarded), 5)
+            self.assertTrue(all(type(item) is bytes for item in discarded))
+            start = time.monotonic()
+            release.set()
+            flusher.join(5)
+            self.assertEqual(flushed, [True])
+            self.assertLess(time.monotonic() - start, 1.0)
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [0, 6, 7, 8])
+
+    def test_close_timeout(self):
+        spilled = []
+        release = threading.Event()
+
+        def _send_data(bytes_, more=False):
+            # a collector that does not answer, then goes away
+            release.wait(5)
+            raise OSError("collector down")
+
+        sender = self._sender
+        sender.buffer_overflow_handler = spilled.append
+        sender._send_data = _send_data
+        for i in range(10):
+            sender.emit("foo", {"n": i})
+        start = time.monotonic()
+        sender.close(timeout=0.1)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertTrue(spilled)
+        release.set()
+        sender._send_thread.join(5)
+        self.assertFalse(sender._send_thread.is_alive())
+
+        spilled = [
+            d[2]["n"] for chunk in spilled for d in msgpack.Unpacker(BytesIO(chunk))
+        ]
+        self.assertEqual(sorted(spilled), list(range(10)))
+
+    def test_close_timeout_full_queue(self):
+        release = threading.Event()
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test", port=self._server.port, queue_maxsize=3
+        )
+
+        def _send_data(bytes_, more=False):
+            release.wait(5)
+            raise OSError("collector down")
+
+        sender = self._sender
+        sender.buffer_overflow_handler = lambda pendings: None
+        sender._send_data = _send_data
+        for i in range(4):
+            sender.emit("foo", {"n": i})
+        # a producer waiting for room in the queue
+        emitted = []
+        producer = threading.Thread(
+            target=lambda: emitted.append(sender.emit("foo", {"n": 4}))
+        )
+        producer.start()
+        time.sleep(0.05)
+        start = time.monotonic()
+        sender.close(timeout=0.2)
+        self.assertLess(time.monotonic() - start, 1.0)
+        producer.join(1.0)
+        self.assertEqual(emitted, [False])
+        release.set()
+        sender._send_thread.join(5)
+        self.assertFalse(sender._send_thread.is_alive())
+
+    def test_drain_at_exit(self):
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test", port=self._server.port, drain_at_exit=1.0
+        )
+        self.assertIn(self._sender, fluent.asyncsender._draining_senders)
+        self._sender.emit("foo", {"n": 1})
+        fluent.asyncsender._drain_at_exit()
+        self.assertTrue(self._sender._closed)
+        self.assertNotIn(self._sender, fluent.asyncsender._draining_senders)
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1])
+
+    @unittest.skipUnless(hasattr(signal, "SIGUSR1"), "SIGUSR1 not supported")
+    def test_exit_on_signal(self):
+        previous = signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        try:
+            fluent.asyncsender.exit_on_signal(signal.SIGUSR1)
+            with self.assertRaises(SystemExit) as cm:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                # delivered between bytecodes of the main thread
+                time.sleep(1)
+            self.assertEqual(cm.exception.code, 128 + signal.SIGUSR1)
+
+            # handled signals are left alone
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            fluent.asyncsender.exit_on_signal(signal.SIGUSR1)
+            self.assertEqual(signal.getsignal(signal.SIGUSR1), signal.SIG_IGN)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+
 
 class TestSenderDefaultProperties(unittest.TestCase):
     def setUp(self):
@@ -282,6 +563,289 @@ class TestSenderWithTimeoutAndCircular(unittest.TestCase):
         self.assertTrue(isinstance(data[2][1], int))
 
 
+class TestSenderStreamCircular(unittest.TestCase):
+    Q_SIZE = 3
+
+    def setUp(self):
+        super().setUp()
+        self._server = mockserver.MockRecvServer("localhost")
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            queue_maxsize=self.Q_SIZE,
+            queue_circular=True,
+        )
+
+    def tearDown(self):
+        try:
+            self._sender.close()
+        finally:
+            self._server.close()
+
+    def test_emit_stream(self):
+        with self._sender as sender:
+            events = ((1, {"n": i}) for i in range(2000))
+            self.assertEqual(sender.emit_stream("foo", events, frame_size=256), 2000)
+
+        data = self._server.get_received()
+        entries = [entry for tag, frame_entries in data for entry in frame_entries]
+        # nothing was discarded from the circular queue
+        self.assertEqual([entry[1]["n"] for entry in entries], list(range(2000)))
+
+
+class TestPriorityQueue(unittest.TestCase):
+    def setUp(self):
+        self.overflows = []
+        self.queue = fluent.asyncsender._PriorityQueue(
+            {40: 10, 20: 10, 0: 6}, self.overflows.append
+        )
+
+    def test_class_index(self):
+        index = self.queue.class_index
+        self.assertEqual([index(50), index(40), index(30), index(None)], [0, 0, 1, 1])
+        self.assertEqual([index(10), index(0), index(-5)], [2, 2, 2])
+
+    def test_order_and_shedding(self):
+        queue = self.queue
+        with self.assertRaises(Empty):
+            queue.get(block=False)
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.01)
+        for item in (b"d1-", b"d2-", b"d3-"):
+            queue.put(item, block=False, priority=10)
+        queue.put(b"i1-", block=False)
+        queue.put(b"e1-", block=False, priority=40)
+        # the debug class sheds its own oldest event only
+        self.assertEqual(self.overflows, [b"d1-"])
+        self.assertEqual(
+            queue.stats,
+            {
+                40: {"bytes": 3, "dropped": 0},
+                20: {"bytes": 3, "dropped": 0},
+                0: {"bytes": 6, "dropped": 1},
+            },
+        )
+
+        queue.put(fluent.asyncsender._TOMBSTONE)
+        received = []
+        while True:
+            item = queue.get()
+            if item is fluent.asyncsender._TOMBSTONE:
+                break
+            received.append(item)
+        self.assertEqual(received, [b"e1-", b"i1-", b"d2-", b"d3-"])
+
+    def test_blocking_put(self):
+        queue = self.queue
+        queue.put(b"0123456789", priority=40)
+        # a single event larger than the budget still fits an empty class
+        queue.put(b"0123456789", priority=0)
+        with self.assertRaises(Full):
+            queue.put(b"x", timeout=0.05, priority=40)
+        # other classes are not blocked
+        queue.put(b"x", timeout=0.05, priority=20)
+
+        threading.Timer(0.05, queue.get).start()
+        queue.put(b"x", timeout=5, priority=40)
+        self.assertEqual(queue.stats[40]["bytes"], 1)
+
+    def test_barrier(self):
+        queue = self.queue
+        barrier = fluent.asyncsender._Barrier()
+        queue.put(b"d", priority=10)
+        self.assertTrue(queue.put(barrier))
+        queue.put(b"e", priority=40)
+        queue.put(fluent.asyncsender._TOMBSTONE)
+        # once the events put before it are taken, before the tombstone
+        self.assertEqual(
+            [queue.get() for _ in range(4)],
+            [b"e", b"d", barrier, fluent.asyncsender._TOMBSTONE],
+        )
+        self.assertFalse(queue.put(fluent.asyncsender._Barrier()))
+
+    def test_barrier_position(self):
+        queue = self.queue
+        barrier = fluent.asyncsender._Barrier()
+        queue.put(b"d1", priority=10)
+        queue.put(barrier)
+        queue.put(b"e1", priority=40)
+        queue.put(b"d2", priority=10)
+        # not held back by the events put after it
+        self.assertEqual(
+            [queue.get(block=False) for _ in range(4)], [b"e1", b"d1", barrier, b"d2"]
+        )
+
+    def test_barrier_discarded_events(self):
+        queue = self.queue
+        barrier = fluent.asyncsender._Barrier()
+        for _ in range(3):
+            queue.put(b"dd", priority=10)
+        queue.put(barrier)
+        for item in (b"xx", b"yy", b"zz"):
+            queue.put(item, block=False, priority=10)
+        self.assertEqual(self.overflows, [b"dd"] * 3)
+        self.assertEqual(
+            [queue.get(block=False) for _ in range(4)], [barrier, b"xx", b"yy", b"zz"]
+        )
+
+    def test_closed(self):
+        queue = self.queue
+        queue.put(b"0123456789", priority=40)
+        # a producer waiting for room is released by the tombstone
+        threading.Timer(0.05, queue.put, (fluent.asyncsender._TOMBSTONE,)).start()
+        self.assertFalse(queue.put(b"x", timeout=5, priority=40))
+        self.assertFalse(queue.put(b"x", block=False, priority=20))
+        self.assertEqual(queue.get(), b"0123456789")
+        self.assertIs(queue.get(), fluent.asyncsender._TOMBSTONE)
+
+
+class TestSenderWithPriorities(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._server = mockserver.MockRecvServer("localhost")
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            queue_circular=True,
+            queue_priorities={40: 1024, 0: 1024},
+        )
+
+    def tearDown(self):
+        try:
+            self._sender.close()
+        finally:
+            self._server.close()
+
+    def test_simple(self):
+        with self._sender as sender:
+            self.assertTrue(sender.emit("debug", {"n": 1}, priority=10))
+            self.assertTrue(sender.emit("info", {"n": 2}))
+            self.assertTrue(sender.emit_with_time("error", 1, {"n": 3}, priority=40))
+            self.assertEqual(set(sender.queue_stats), {40, 0})
+            self.assertTrue(sender.flush(5))
+            self.assertEqual(sender.queue_stats[40]["bytes"], 0)
+
+        data = self._server.get_received()
+        self.assertEqual(sorted(d[2]["n"] for d in data), [1, 2, 3])
+        self.assertEqual(self._sender.queue_stats[0]["dropped"], 0)
+        self.assertFalse(self._sender.emit("late", {"n": 4}))
+
+
+class TestBatchController(unittest.TestCase):
+    def update(self, controller, elapsed, nevents, queue_depth=0):
+        controller._updated_at -= elapsed
+        controller.update(nevents, nevents * 100, 0.001, queue_depth)
+
+    def test_sparse(self):
+        controller = fluent.asyncsender._BatchController(0.05, 1 << 20)
+        self.update(controller, 1.0, 10)
+        self.assertEqual(controller.linger, 0.0)
+        self.assertEqual(controller.batch_size, controller.MIN_SIZE)
+
+    def test_steady(self):
+        controller = fluent.asyncsender._BatchController(0.05, 1 << 20)
+        self.update(controller, 1.0, 10000)
+        self.assertAlmostEqual(controller.arrival_rate, 10000, delta=100)
+        self.assertAlmostEqual(controller.linger, 0.049, delta=0.001)
+        # about 490 events of 100 bytes arrive while a batch waits
+        self.assertAlmostEqual(controller.batch_size, 49000, delta=1000)
+        self.update(controller, 1.0, 100000)
+        self.assertAlmostEqual(controller.batch_size, 490000, delta=10000)
+
+    def test_backlog(self):
+        controller = fluent.asyncsender._BatchController(0.05, 1 << 16)
+        self.update(controller, 1.0, 10)
+        self.update(controller, 0.01, 100, queue_depth=500)
+        self.assertEqual(controller.linger, 0.0)
+        self.assertEqual(controller.batch_size, controller.MIN_SIZE * 2)
+        for _ in range(5):
+            self.update(controller, 0.01, 100, queue_depth=500)
+        self.assertEqual(controller.batch_size, 1 << 16)
+        self.assertEqual(controller.stats["queue_depth"], 500)
+
+
+class TestSenderWithBatching(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._server = mockserver.MockRecvServer("localhost")
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            queue_maxsize=1000,
+            batch_max_latency=0.05,
+        )
+
+    def tearDown(self):
+        try:
+            self._sender.close()
+        finally:
+            self._server.close()
+
+    def test_simple(self):
+        sent = []
+        send_data = self._sender._send_data
+
+        def _send_data(bytes_, more=False):
+            sent.append(bytes_)
+            send_data(bytes_, more)
+
+        self._sender._send_data = _send_data
+        with self._sender as sender:
+            for i in range(1000):
+                sender.emit("foo", {"n": i})
+            self.assertTrue(sender.flush(5))
+            self.assertEqual(
+                sum(len(list(msgpack.Unpacker(BytesIO(b)))) for b in sent), 1000
+            )
+            stats = sender.batch_stats
+            self.assertEqual(
+                set(stats),
+                {"linger", "batch_size", "arrival_rate", "send_latency", "queue_depth"},
+            )
+            self.assertLessEqual(stats["linger"], 0.05)
+
+        data = self._server.get_received()
+        self.assertEqual([d[2]["n"] for d in data], list(range(1000)))
+        self.assertLess(len(sent), 1000)
+
+    def test_flush_priority(self):
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            queue_maxsize=1000,
+            batch_max_latency=10.0,
+            flush_priority=40,
+        )
+        sent = []
+        written = threading.Event()
+        send_data = self._sender._send_data
+
+        def _send_data(bytes_, more=False):
+            sent.append(bytes_)
+            send_data(bytes_, more)
+            written.set()
+
+        self._sender._send_data = _send_data
+        self._sender._batcher.linger = 10.0
+        with self._sender as sender:
+            for i in range(3):
+                sender.emit("foo", {"n": i})
+            sender.emit("foo", {"n": 3}, priority=40)
+            # not held back for the linger time, nor are the events before it
+            self.assertTrue(written.wait(5))
+            self.assertEqual(
+                [d[2]["n"] for d in msgpack.Unpacker(BytesIO(sent[0]))], [0, 1, 2, 3]
+            )
+
+    def test_disabled(self):
+        self._sender.close()
+        self._sender = fluent.asyncsender.FluentSender(
+            tag="test", port=self._server.port
+        )
+        self.assertEqual(self._sender.batch_stats, {})
+
+
 class TestSenderWithTimeoutMaxSizeNonCircular(unittest.TestCase):
     Q_SIZE = 3
 
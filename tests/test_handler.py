@@ -1,8 +1,15 @@
 import logging
+import os
+import sys
+import threading
+import time
 import unittest
 
 import fluent.handler
+import fluent.sampling
+import fluent.sender
 from tests import mockserver
+from tests.test_sender import run_in_child
 
 
 def get_logger(name, level=logging.INFO):
@@ -350,3 +357,387 @@ class TestHandler(unittest.TestCase):
         self.assertTrue("it failed" in message)
         self.assertTrue('tests/test_handler.py", line' in message)
         self.assertTrue("Exception: sample exception" in message)
+
+    def test_sampling_rules(self):
+        handler = fluent.handler.FluentHandler(
+            "app.follow",
+            port=self._port,
+            sampling_rules=[
+                fluent.sampling.SamplingRule(
+                    fluent.sampling.BurstSampler(first=2), level=logging.WARNING
+                )
+            ],
+        )
+        formatter = fluent.handler.FluentRecordFormatter()
+        formatted = []
+
+        def format(record):
+            formatted.append(record)
+            return fluent.handler.FluentRecordFormatter.format(formatter, record)
+
+        formatter.format = format
+
+        with handler:
+            log = get_logger("fluent.test_sampling")
+            handler.setFormatter(formatter)
+            log.addHandler(handler)
+            for i in range(10):
+                log.warning({"n": i})
+            log.error({"n": 10})
+            log.removeHandler(handler)
+
+            self.assertEqual(handler.sampling_drops, {"level=WARNING": 8})
+
+        self.assertEqual(len(formatted), 3)
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [0, 1, 10])
+
+    def test_collapse_repeats(self):
+        handler = fluent.handler.FluentHandler(
+            "app.follow", port=self._port, collapse_window=60
+        )
+
+        with handler:
+            log = get_logger("fluent.test_collapse")
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log.addHandler(handler)
+            for i in range(5):
+                log.warning("retrying %d", i)
+            log.info("done")
+            log.removeHandler(handler)
+
+        data = self.get_data()
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[0][2]["message"], "retrying 0")
+        self.assertEqual(data[1][2]["message"], "done")
+        self.assertEqual(data[2][2]["message"], "retrying 4")
+        self.assertEqual(data[2][2]["repeat_count"], 4)
+        self.assertLessEqual(
+            data[2][2]["first_timestamp"], data[2][2]["last_timestamp"]
+        )
+
+    def test_custom_sender_class(self):
+        emitted = []
+
+        class Sender(fluent.sender.FluentSender):
+            # emit_with_time of senders predating event priorities
+            def emit_with_time(self, label, timestamp, data):
+                emitted.append(data)
+                return True
+
+        class Handler(fluent.handler.FluentHandler):
+            def getSenderClass(self):
+                return Sender
+
+        with Handler("app.follow", port=self._port) as handler:
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test_custom_sender")
+            log.addHandler(handler)
+            log.error("boom")
+            log.removeHandler(handler)
+
+        self.assertEqual(emitted[0]["message"], "boom")
+
+    def test_flush_priority(self):
+        priorities = []
+
+        class Sender(fluent.sender.FluentSender):
+            def emit_with_time(self, label, timestamp, data, *, priority=None):
+                priorities.append(priority)
+                return super().emit_with_time(label, timestamp, data, priority=priority)
+
+        class Handler(fluent.handler.FluentHandler):
+            def getSenderClass(self):
+                return Sender
+
+        with Handler(
+            "app.follow", port=self._port, flush_priority=logging.ERROR
+        ) as handler:
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test_flush_priority")
+            log.addHandler(handler)
+            log.info("fine")
+            log.error("boom")
+            log.removeHandler(handler)
+
+        self.assertEqual(priorities, [logging.INFO, logging.ERROR])
+        data = self.get_data()
+        self.assertEqual([d[2]["message"] for d in data], ["fine", "boom"])
+
+    def test_prewarm(self):
+        with fluent.handler.FluentHandler(
+            "app.follow", port=self._port, prewarm=True
+        ) as handler:
+            # the sender is connecting before anything is logged
+            self.assertIsNotNone(handler._sender)
+            self.assertTrue(handler.sender.wait_ready(3))
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test_prewarm")
+            log.addHandler(handler)
+            log.info("hello")
+            log.removeHandler(handler)
+
+        data = self.get_data()
+        self.assertEqual(data[0][2]["message"], "hello")
+
+    def test_shared_transport(self):
+        handlers = [
+            fluent.handler.FluentHandler(tag, port=self._port, shared_transport=True)
+            for tag in ("app.first", "app.second")
+        ]
+        for name, handler in zip(("first", "second"), handlers):
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test_shared_" + name)
+            log.addHandler(handler)
+            log.info("hello %s", name)
+            log.removeHandler(handler)
+        self.assertIs(handlers[0].sender._transport, handlers[1].sender._transport)
+        for handler in handlers:
+            handler.close()
+
+        data = self.get_data()
+        self.assertEqual(
+            [(d[0], d[2]["message"]) for d in data],
+            [("app.first", "hello first"), ("app.second", "hello second")],
+        )
+
+    def test_without_emit_lock(self):
+        handler = fluent.handler.FluentHandler(
+            "app.follow", port=self._port, emit_lock=False
+        )
+        with handler:
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log = get_logger("fluent.test")
+            log.addHandler(handler)
+            handler.sender  # noqa: B018 - created before the lock is held
+
+            def log_records(i):
+                for j in range(100):
+                    log.info("record %d", i * 100 + j)
+
+            threads = [
+                threading.Thread(target=log_records, args=(i,)) for i in range(8)
+            ]
+            # records are emitted while another thread holds the handler lock
+            handler.acquire()
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(10)
+                self.assertFalse(any(thread.is_alive() for thread in threads))
+            finally:
+                handler.release()
+            log.removeHandler(handler)
+
+        data = self.get_data()
+        self.assertEqual(
+            sorted(int(d[2]["message"].split()[1]) for d in data), list(range(800))
+        )
+
+    def test_collapse_burst_then_silence(self):
+        handler = fluent.handler.FluentHandler(
+            "app.follow", port=self._port, collapse_window=0.05
+        )
+
+        with handler:
+            log = get_logger("fluent.test_collapse_silence")
+            handler.setFormatter(fluent.handler.FluentRecordFormatter())
+            log.addHandler(handler)
+            for i in range(3):
+                log.error("failed %d", i)
+            log.removeHandler(handler)
+            deadline = time.monotonic() + 5
+            while handler._collapser._bursts and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # sent by the expiry thread, nothing left for close()
+            self.assertEqual(handler._collapser.flush(), [])
+
+        data = self.get_data()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[1][2]["message"], "failed 2")
+        self.assertEqual(data[1][2]["repeat_count"], 2)
+
+
+class TestRecordCollapser(unittest.TestCase):
+    def make_record(self, created, msg="message", lineno=1):
+        record = logging.LogRecord(
+            "app", logging.WARNING, __file__, lineno, msg, None, None
+        )
+        record.created = created
+        return record
+
+    def test_window(self):
+        collapser = fluent.handler.RecordCollapser(window=10)
+        first = self.make_record(100)
+        self.assertEqual(collapser.collapse(first), [first])
+        self.assertEqual(collapser.collapse(self.make_record(101)), [])
+        last = self.make_record(105)
+        self.assertEqual(collapser.collapse(last), [])
+
+        other = self.make_record(111, lineno=2)
+        summary, record = collapser.collapse(other)
+        self.assertIs(record, other)
+        self.assertEqual(summary.repeat_count, 2)
+        self.assertEqual(summary.first_timestamp, 101)
+        self.assertEqual(summary.last_timestamp, 105)
+        self.assertFalse(hasattr(last, "repeat_count"))
+
+        # a burst without repeats leaves no summary
+        self.assertEqual(collapser.flush(), [])
+
+    def test_max_keys(self):
+        collapser = fluent.handler.RecordCollapser(window=10, max_keys=2)
+        collapser.collapse(self.make_record(100, lineno=1))
+        collapser.collapse(self.make_record(100, lineno=1))
+        collapser.collapse(self.make_record(100, lineno=2))
+        third = self.make_record(100, lineno=3)
+        summary, record = collapser.collapse(third)
+        self.assertEqual(summary.lineno, 1)
+        self.assertEqual(summary.repeat_count, 1)
+        self.assertIs(record, third)
+
+    def test_expiry_without_later_records(self):
+        expired = []
+        collapser = fluent.handler.RecordCollapser(
+            window=0.05, on_expire=expired.append
+        )
+        try:
+            now = time.time()
+            collapser.collapse(self.make_record(now))
+            collapser.collapse(self.make_record(now + 0.01))
+            collapser.collapse(self.make_record(now + 0.02))
+            deadline = time.monotonic() + 5
+            while not expired and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual(len(expired), 1)
+            self.assertEqual(expired[0].repeat_count, 2)
+            self.assertEqual(collapser.flush(), [])
+        finally:
+            collapser.close()
+        collapser._thread.join(1)
+        self.assertFalse(collapser._thread.is_alive())
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "fork not supported")
+    def test_fork(self):
+        collapser = fluent.handler.RecordCollapser(window=10)
+        collapser.collapse(self.make_record(100))
+        collapser.collapse(self.make_record(101))
+
+        def child():
+            # the parent's held repeat is not summarized again
+            return len(collapser.flush())
+
+        self.assertEqual(run_in_child(child), 0)
+        (summary,) = collapser.flush()
+        self.assertEqual(summary.repeat_count, 1)
+
+    def test_non_string_messages_pass_through(self):
+        collapser = fluent.handler.RecordCollapser(window=10)
+        record = self.make_record(100, msg={"a": 1})
+        self.assertEqual(collapser.collapse(record), [record])
+        self.assertEqual(collapser.collapse(record), [record])
+
+
+LAYOUTS = {
+    "%": {"name": "%(name)s", "line": "%(lineno)s", "at": "%(name)s:%(lineno)d"},
+    "{": {"name": "{name}", "line": "{lineno}", "at": "{name}:{lineno:d}"},
+    "$": {"name": "$name", "line": "${lineno}", "at": "${name}:$lineno"},
+}
+
+
+class TestFormatLayout(unittest.TestCase):
+    def test_same_as_templates(self):
+        record = logging.makeLogRecord({"name": "app", "lineno": 12, "msg": "x"})
+        for style, fmt in LAYOUTS.items():
+            formatter = fluent.handler.FluentRecordFormatter(fmt=fmt, style=style)
+            data = formatter.format(record)
+            self.assertEqual(
+                {key: data[key] for key in fmt},
+                {"name": "app", "line": "12", "at": "app:12"},
+            )
+
+    def test_missing_attribute(self):
+        record = logging.makeLogRecord({"name": "app", "msg": "x"})
+        for style, field in (
+            ("%", "%(missing)s"),
+            ("{", "{missing}"),
+            ("$", "$missing"),
+        ):
+            fmt = {"name": LAYOUTS[style]["name"], "custom": field}
+            formatter = fluent.handler.FluentRecordFormatter(fmt=fmt, style=style)
+            with self.assertRaises(KeyError):
+                formatter.format(record)
+            formatter = fluent.handler.FluentRecordFormatter(
+                fmt=fmt, style=style, fill_missing_fmt_key=True
+            )
+            self.assertIsNone(formatter.format(record)["custom"])
+
+
+def fail(message):
+    try:
+        raise KeyError("missing")
+    except KeyError as e:
+        raise ValueError(message) from e
+
+
+def exc_info_of(func, *args):
+    try:
+        func(*args)
+    except (TypeError, ValueError):
+        return sys.exc_info()
+
+
+class TestTracebackCache(unittest.TestCase):
+    def make_record(self, exc_info):
+        return logging.makeLogRecord(
+            {
+                "name": "app",
+                "msg": "failed",
+                "levelno": logging.ERROR,
+                "exc_info": exc_info,
+            }
+        )
+
+    def test_same_as_standard(self):
+        formatter = fluent.handler.FluentRecordFormatter()
+        standard = logging.Formatter()
+        for message in ("first", "second"):
+            exc_info = exc_info_of(fail, message)
+            text = formatter.formatException(exc_info)
+            self.assertEqual(text, standard.formatException(exc_info))
+            # the message is not cached with the traceback
+            self.assertTrue(text.endswith("ValueError: " + message))
+        self.assertEqual(len(formatter._tracebacks), 1)
+
+    def test_size(self):
+        formatter = fluent.handler.FluentRecordFormatter(traceback_cache_size=2)
+        for func in (fail, int, len):
+            formatter.formatException(exc_info_of(func, None))
+        self.assertEqual(len(formatter._tracebacks), 2)
+
+        formatter = fluent.handler.FluentRecordFormatter(traceback_cache_size=0)
+        formatter.formatException(exc_info_of(fail, "first"))
+        self.assertEqual(len(formatter._tracebacks), 0)
+
+    def test_interval(self):
+        formatter = fluent.handler.FluentRecordFormatter(traceback_interval=60)
+        records = [self.make_record(exc_info_of(fail, m)) for m in ("first", "second")]
+        first, second = [formatter.format(record) for record in records]
+
+        self.assertIn("Traceback (most recent call last)", first["message"])
+        self.assertTrue(first["message"].endswith("ValueError: first"))
+        self.assertEqual(second["message"], "failed\nValueError: second")
+        self.assertEqual(len(first["exc_fingerprint"]), 16)
+        self.assertEqual(first["exc_fingerprint"], second["exc_fingerprint"])
+        # left for other handlers to render in full
+        self.assertIsNone(records[1].exc_text)
+
+        other = formatter.format(self.make_record(exc_info_of(len, None)))
+        self.assertIn("Traceback (most recent call last)", other["message"])
+        self.assertNotEqual(other["exc_fingerprint"], first["exc_fingerprint"])
+
+        formatter._tracebacks[next(iter(formatter._tracebacks))][2] -= 60
+        third = formatter.format(self.make_record(exc_info_of(fail, "third")))
+        self.assertIn("Traceback (most recent call last)", third["message"])
@@ -0,0 +1,141 @@
+import functools
+import gc
+import logging
+import socket
+import tracemalloc
+import unittest
+
+import fluent.asynchandler
+import fluent.asyncsender
+import fluent.handler
+import fluent.sender
+from tests import mockserver
+
+EVENTS = 2000
+RECORD = {"message": "x" * 100, "status": 200}
+
+
+def trace(func, n=EVENTS):
+    """Calls `func` `n` times under tracemalloc, after warming it up.
+
+    Returns the bytes and the number of memory blocks left allocated by the
+    calls, and the peak of allocated bytes during the calls, above what was
+    allocated before them.
+    """
+    for _ in range(10):
+        func()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        start = tracemalloc.get_traced_memory()[0]
+        for _ in range(n):
+            func()
+        peak = tracemalloc.get_traced_memory()[1] - start
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    ignored = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ]
+    stats = after.filter_traces(ignored).compare_to(
+        before.filter_traces(ignored), "filename"
+    )
+    return (
+        sum(stat.size_diff for stat in stats),
+        sum(stat.count_diff for stat in stats),
+        peak,
+    )
+
+
+def unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class TestEmitMemory(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._server = mockserver.MockDiscardServer("localhost")
+
+    def tearDown(self):
+        self._server.close()
+
+    def assertBounded(self, traced, queued=0):
+        size, count, peak = traced
+        # nothing is kept per event, but the events still queued
+        self.assertLess(count, queued + 20)
+        self.assertLess(size, (queued + 20) * 256)
+        self.assertLess(peak, queued * 256 + 16 * 1024)
+
+    def test_sender_emit(self):
+        with fluent.sender.FluentSender("test", port=self._server.port) as sender:
+            traced = trace(lambda: sender.emit("foo", RECORD))
+        self.assertBounded(traced)
+
+    def test_async_sender_emit(self):
+        with fluent.asyncsender.FluentSender(
+            "test", port=self._server.port, queue_maxsize=100
+        ) as sender:
+            traced = trace(lambda: sender.emit("foo", RECORD))
+        self.assertBounded(traced, queued=100)
+
+    def test_handler_emit(self):
+        for module, queued in (
+            (fluent.handler, 0),
+            (fluent.asynchandler, fluent.asyncsender.DEFAULT_QUEUE_MAXSIZE),
+        ):
+            with self.subTest(module=module.__name__):
+                server = mockserver.MockDiscardServer("localhost")
+                handler = module.FluentHandler("app", port=server.port)
+                handler.setFormatter(fluent.handler.FluentRecordFormatter())
+                log = logging.getLogger(f"fluent.test.memory.{module.__name__}")
+                log.propagate = False
+                log.setLevel(logging.INFO)
+                log.addHandler(handler)
+                try:
+                    traced = trace(
+                        functools.partial(log.info, "request %d handled", 200)
+                    )
+                finally:
+                    log.removeHandler(handler)
+                    handler.close()
+                    server.close()
+                self.assertBounded(traced, queued)
+
+
+class TestCollectorDownMemory(unittest.TestCase):
+    BUFMAX = 64 * 1024
+
+    def test_sender_pendings(self):
+        overflows = []
+        with fluent.sender.FluentSender(
+            "test",
+            port=unused_port(),
+            bufmax=self.BUFMAX,
+            buffer_overflow_handler=lambda pendings: overflows.append(len(pendings)),
+        ) as sender:
+            size, _, peak = trace(lambda: sender.emit("foo", RECORD))
+            self.assertTrue(overflows)
+        # pendings is discarded once over bufmax
+        self.assertLess(size, self.BUFMAX + 16 * 1024)
+        self.assertLess(peak, 2 * self.BUFMAX + 16 * 1024)
+
+    def test_async_sender_queue(self):
+        with fluent.asyncsender.FluentSender(
+            "test",
+            port=unused_port(),
+            bufmax=self.BUFMAX,
+            queue_maxsize=100,
+            queue_circular=True,
+        ) as sender:
+            size, _, peak = trace(lambda: sender.emit("foo", RECORD))
+        # the queue, the pendings of the sending thread and one copy of them
+        self.assertLess(size, 100 * 256 + 2 * self.BUFMAX + 16 * 1024)
+        self.assertLess(peak, 100 * 256 + 2 * self.BUFMAX + 16 * 1024)
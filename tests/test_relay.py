@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import msgpack
+
+import fluent.relay
+import fluent.sender
+from tests import mockserver
+from tests.test_sender import run_in_child
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._server = mockserver.MockRecvServer("localhost")
+        self._tempdir = mkdtemp()
+        self._path = os.path.join(self._tempdir, "relay.sock")
+        self._relay = fluent.relay.Relay(
+            "unix://" + self._path, port=self._server.port, flush_interval=10
+        )
+        self._relay.start()
+
+    def tearDown(self):
+        try:
+            self._relay.close()
+            self._server.close()
+        finally:
+            rmtree(self._tempdir, True)
+
+    def get_sender(self, tag):
+        return fluent.sender.FluentSender(tag, host="unix://" + self._path)
+
+    def get_data(self):
+        self._relay.close()
+        return self._server.get_received()
+
+    def test_groups_by_tag(self):
+        sender = self.get_sender("app")
+        sender.emit("a", {"n": 1})
+        sender.emit_with_time("b", fluent.sender.EventTime(1490061367.5), {"n": 2})
+        sender.emit_many("a", [(123, {"n": 3}), (124, {"n": 4})])
+        sender.emit("a", {"n": 5})
+        sender.close()
+        other = self.get_sender("app")
+        other.emit("b", {"n": 6})
+        other.close()
+
+        data = self.get_data()
+        self.assertEqual(len(data), 2)
+        frames = {tag: entries for tag, entries in data}
+        self.assertEqual([record["n"] for _, record in frames["app.a"]], [1, 3, 4, 5])
+        # producers are read in no particular order
+        self.assertEqual(sorted(record["n"] for _, record in frames["app.b"]), [2, 6])
+        self.assertEqual(frames["app.a"][1][0], 123)
+        self.assertIn(
+            fluent.sender.EventTime(1490061367.5), [t for t, _ in frames["app.b"]]
+        )
+
+    def test_reencodes_foreign_packing(self):
+        sender = self.get_sender("app")
+        # tag packed as str 8 rather than fixstr, and a message with options
+        sender._send(b"\x93\xd9\x05app.a" + msgpack.packb([1, {"n": 1}])[1:])
+        sender._send(msgpack.packb(["app.a", 2, {"n": 2}, {"size": 1}]))
+        sender._send(msgpack.packb(["app.a", [[3, {"n": 3}]], {"size": 1}]))
+        sender.close()
+
+        data = self.get_data()
+        self.assertEqual(
+            data, [["app.a", [[1, {"n": 1}], [2, {"n": 2}], [3, {"n": 3}]]]]
+        )
+
+    def test_packed_forward_passthrough(self):
+        entries = msgpack.packb([1, {"n": 1}]) + msgpack.packb([2, {"n": 2}])
+        sender = self.get_sender("app")
+        sender._send(msgpack.packb(["app.a", entries]))
+        sender.close()
+
+        data = self.get_data()
+        self.assertEqual(data, [["app.a", entries]])
+
+    def test_flush_interval(self):
+        self._relay.flush_interval = 0.05
+        sender = self.get_sender("app")
+        sender.emit("a", {"n": 1})
+        time.sleep(0.3)
+        sender.emit("a", {"n": 2})
+        sender.close()
+
+        data = self.get_data()
+        self.assertEqual(
+            [[record for _, record in entries] for _, entries in data],
+            [[{"n": 1}], [{"n": 2}]],
+        )
+
+    def test_flush_size(self):
+        self._relay.flush_size = 1
+        sender = self.get_sender("app")
+        for i in range(3):
+            sender.emit("a", {"n": i})
+        sender.close()
+
+        data = self.get_data()
+        records = [record["n"] for _, entries in data for _, record in entries]
+        self.assertEqual(records, [0, 1, 2])
+
+    def test_producer_processes(self):
+        def produce():
+            sender = self.get_sender("app")
+            sender.emit("a", {"pid": os.getpid()})
+            sender.close()
+            return os.getpid()
+
+        pids = [run_in_child(produce) for _ in range(3)]
+
+        data = self.get_data()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(
+            sorted(record["pid"] for _, record in data[0][1]), sorted(pids)
+        )
+
+    def test_malformed_producer_dropped(self):
+        bad = self.get_sender("app")
+        bad._send(msgpack.packb(["app.a", 123]))
+        bad.close()
+        sender = self.get_sender("app")
+        sender.emit("a", {"n": 1})
+        sender.emit("a", {1: "x"})
+        sender.close()
+
+        self._relay.close()
+        self._server.join()
+        data = msgpack.Unpacker(strict_map_key=False)
+        data.feed(self._server._buf.getvalue())
+        self.assertEqual(
+            [record for _, entries in data for _, record in entries],
+            [{"n": 1}, {1: "x"}],
+        )
+
+    def test_unhashable_key_producer_dropped(self):
+        bad = self.get_sender("app")
+        # a map with an array key
+        bad._send(b"\x81\x91\x01\x02")
+        bad.close()
+        sender = self.get_sender("app")
+        self.assertTrue(sender.emit("a", {"n": 1}))
+        sender.close()
+
+        data = self.get_data()
+        self.assertEqual(data, [["app.a", [[data[0][1][0][0], {"n": 1}]]]])
+
+    def test_serve_forever_in_other_thread(self):
+        self._relay.close()
+        relay = fluent.relay.Relay(
+            "unix://" + self._path, port=self._server.port, flush_interval=10
+        )
+        thread = threading.Thread(target=relay.serve_forever)
+        thread.start()
+        sender = self.get_sender("app")
+        sender.emit("a", {"n": 1})
+        sender.close()
+        relay.close()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self._path))
+        data = self._server.get_received()
+        self.assertEqual(data[0][1][0][1], {"n": 1})
+
+    def test_close_without_serving(self):
+        self._relay.close()
+        relay = fluent.relay.Relay("unix://" + self._path, port=self._server.port)
+        relay.close()
+
+        self.assertFalse(os.path.exists(self._path))
+        self.assertEqual(relay._server.fileno(), -1)
+        self.assertIsNone(relay.sender.socket)
+
+    def test_socket_removed_on_close(self):
+        self._relay.close()
+        self.assertFalse(os.path.exists(self._path))
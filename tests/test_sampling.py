@@ -0,0 +1,62 @@
+import logging
+import unittest
+from unittest import mock
+
+from fluent import sampling
+
+
+def make_record(name="app", level=logging.WARNING):
+    return logging.LogRecord(name, level, __file__, 1, "message", None, None)
+
+
+class TestSamplers(unittest.TestCase):
+    def test_ratio(self):
+        sampler = sampling.RatioSampler(0.25)
+        self.assertEqual(sum(sampler.sample() for _ in range(100)), 25)
+        self.assertFalse(any(sampling.RatioSampler(0).sample() for _ in range(10)))
+        self.assertTrue(all(sampling.RatioSampler(1).sample() for _ in range(10)))
+        with self.assertRaises(ValueError):
+            sampling.RatioSampler(2)
+
+    @mock.patch("fluent.sampling.time.monotonic")
+    def test_token_bucket(self, monotonic):
+        monotonic.return_value = 100.0
+        sampler = sampling.TokenBucketSampler(rate=10, burst=5)
+        self.assertEqual(sum(sampler.sample() for _ in range(20)), 5)
+        monotonic.return_value = 100.5
+        self.assertEqual(sum(sampler.sample() for _ in range(20)), 5)
+        monotonic.return_value = 100.75
+        self.assertEqual(sum(sampler.sample() for _ in range(20)), 2)
+
+    @mock.patch("fluent.sampling.time.monotonic")
+    def test_burst(self, monotonic):
+        monotonic.return_value = 100.0
+        sampler = sampling.BurstSampler(first=3, then_every=10)
+        kept = [sampler.sample() for _ in range(33)]
+        self.assertEqual(kept[:3], [True] * 3)
+        self.assertEqual(sum(kept), 6)
+        monotonic.return_value = 101.0
+        self.assertTrue(sampler.sample())
+
+        sampler = sampling.BurstSampler(first=1)
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 1)
+
+
+class TestSamplingFilter(unittest.TestCase):
+    def test_rules(self):
+        warnings = sampling.SamplingRule(sampling.RatioSampler(0), level="WARNING")
+        db = sampling.SamplingRule(
+            sampling.RatioSampler(0.5), logger="app.db", name="db"
+        )
+        other = sampling.SamplingRule(sampling.RatioSampler(0), tag="other")
+        filter_ = sampling.SamplingFilter([warnings, db, other], tag="app")
+
+        self.assertFalse(filter_.filter(make_record("app.db", logging.WARNING)))
+        self.assertTrue(filter_.filter(make_record("app", logging.ERROR)))
+        results = [
+            filter_.filter(make_record("app.db.conn", logging.INFO)) for _ in range(4)
+        ]
+        self.assertEqual(sum(results), 2)
+        self.assertTrue(filter_.filter(make_record("app.dbx", logging.INFO)))
+
+        self.assertEqual(filter_.drop_counts, {"level=WARNING": 1, "db": 2})
@@ -1,6 +1,16 @@
 import errno
+import gc
+import json
+import os
+import socket
+import ssl
+import struct
 import sys
+import threading
+import time
 import unittest
+import unittest.mock
+from io import BytesIO
 from shutil import rmtree
 from tempfile import mkdtemp
 
@@ -9,6 +19,27 @@ import msgpack
 import fluent.sender
 from tests import mockserver
 
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+def run_in_child(func):
+    """Runs `func` in a forked child, returns its JSON serializable result"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        try:
+            os.write(write_fd, json.dumps(func()).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
 
 class TestSetup(unittest.TestCase):
     def tearDown(self):
@@ -111,6 +142,336 @@ class TestSender(unittest.TestCase):
         eq(data[0][1].code, 0)
         eq(data[0][1].data, b"X\xd0\x8873[\xb0*")
 
+    def test_nanosecond_event_time(self):
+        time = fluent.sender.EventTime(1490061367, 861646890)
+        sender = self._sender
+        sender.nanosecond_precision = True
+        sender.emit_with_time("foo", time, {"bar": "baz"})
+        sender._close()
+        data = self.get_data()
+        self.assertEqual(data[0][1].data, b"X\xd0\x8873[\xb0*")
+
+    def test_packet_matches_packb(self):
+        sender = self._sender
+        for timestamp in (0, 1490061367, 2**32, fluent.sender.EventTime(1490061367.5)):
+            packet = sender._make_packet(
+                "foo", sender._pack_timestamp(timestamp), {"bar": "baz"}
+            )
+            self.assertEqual(
+                msgpack.unpackb(packet),
+                msgpack.unpackb(msgpack.packb(("test.foo", timestamp, {"bar": "baz"}))),
+            )
+
+    def test_emit_after_pack_error(self):
+        with self._sender as sender:
+            sender.emit("blah", {"a": object()})
+            sender.emit("blah", {"a": "123"})
+
+        data = self._server.get_received()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[1][2], {"a": "123"})
+
+    def test_timestamp_source_cached(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            timestamp_source="cached",
+            timestamp_resolution=60,
+        )
+        with self._sender as sender:
+            sender.emit("foo", {"bar": "baz"})
+            sender.nanosecond_precision = True
+            sender.emit("foo", {"bar": "baz"})
+            sender.emit("foo", {"bar": "baz"})
+        self.assertTrue(sender._clock._stopped.is_set())
+
+        data = self.get_data()
+        self.assertEqual(len(data), 3)
+        self.assertTrue(isinstance(data[0][1], int))
+        self.assertTrue(isinstance(data[1][1], msgpack.ExtType))
+        self.assertEqual(data[1][1], data[2][1])
+        self.assertEqual(data[0][1], struct.unpack(">II", data[1][1].data)[0])
+        self.assertLessEqual(abs(data[0][1] - time.time()), 60)
+
+    def test_timestamp_source_cached_collected(self):
+        s = fluent.sender.FluentSender(
+            tag="test", timestamp_source="cached", timestamp_resolution=0.01
+        )
+        clock = s._clock
+        del s
+        gc.collect()
+
+        self.assertTrue(clock._stopped.is_set())
+        clock._thread.join(1)
+        self.assertFalse(clock._thread.is_alive())
+
+    def test_timestamp_source_monotonic(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, timestamp_source="monotonic"
+        )
+        with self._sender as sender:
+            sender.emit("foo", {"bar": "baz"})
+
+        data = self.get_data()
+        self.assertLessEqual(abs(data[0][1] - time.time()), 1)
+
+    def test_timestamp_source_unknown(self):
+        with self.assertRaises(ValueError):
+            fluent.sender.FluentSender(tag="test", timestamp_source="sundial")
+
+    def test_emit_many(self):
+        with self._sender as sender:
+            self.assertTrue(
+                sender.emit_many(
+                    "foo",
+                    [(1490061367, {"bar": "baz"}), (None, {"bar": "qux"})]
+                    + [(1490061368, {"n": i}) for i in range(20)],
+                )
+            )
+            self.assertTrue(sender.emit_many("foo", []))
+
+        data = self.get_data()
+        self.assertEqual(len(data), 1)
+        tag, entries = data[0]
+        self.assertEqual(tag, "test.foo")
+        self.assertEqual(len(entries), 22)
+        self.assertEqual(entries[0], [1490061367, {"bar": "baz"}])
+        self.assertEqual(entries[1][1], {"bar": "qux"})
+        self.assertTrue(isinstance(entries[1][0], int))
+        self.assertEqual(entries[21], [1490061368, {"n": 19}])
+
+    def test_emit_many_pack_error(self):
+        with self._sender as sender:
+            sender.emit_many("foo", [(1, {"a": object()}), (2, {"a": "123"})])
+
+        data = self.get_data()
+        self.assertEqual(data[0][1][0][1]["message"], "Can't output to log")
+        self.assertEqual(data[0][1][1], [2, {"a": "123"}])
+
+    def test_emit_batch(self):
+        with self._sender as sender:
+            self.assertTrue(
+                sender.emit_batch(
+                    [
+                        ("foo", 1, {"a": 1}),
+                        ("bar", 2, {"a": 2}),
+                        ("foo", 3, {"a": 3}),
+                    ]
+                )
+            )
+
+        data = self.get_data()
+        self.assertEqual(
+            data,
+            [
+                ["test.foo", [[1, {"a": 1}], [3, {"a": 3}]]],
+                ["test.bar", [[2, {"a": 2}]]],
+            ],
+        )
+
+    def test_emit_stream(self):
+        pulled = []
+        progress = []
+
+        def events():
+            for i in range(1000):
+                pulled.append(i)
+                yield (None if i % 2 else 1490061367), {"n": i}
+
+        def on_progress(sent_events, sent_bytes):
+            # events are pulled one frame at a time
+            self.assertEqual(len(pulled), sent_events)
+            progress.append((sent_events, sent_bytes))
+
+        with self._sender as sender:
+            self.assertEqual(
+                sender.emit_stream(
+                    "foo", events(), frame_size=1024, progress=on_progress
+                ),
+                1000,
+            )
+
+        data = self.get_data()
+        self.assertGreater(len(data), 1)
+        self.assertEqual(len(progress), len(data))
+        self.assertEqual(progress[-1][0], 1000)
+        entries = [entry for tag, frame_entries in data for entry in frame_entries]
+        self.assertEqual([entry[1]["n"] for entry in entries], list(range(1000)))
+        self.assertEqual(entries[0][0], 1490061367)
+
+    def test_emit_stream_stalled(self):
+        self._server.close()
+
+        with self._sender as sender:
+            events = iter([(1, {"n": i}) for i in range(100)])
+            self.assertEqual(
+                sender.emit_stream("foo", events, frame_size=64, timeout=0.1), 0
+            )
+            self.assertTrue(sender.pendings)
+            # iteration stopped at the stalled frame
+            _tag, entries = msgpack.unpackb(sender.pendings)
+            self.assertEqual(len(entries) + len(list(events)), 100)
+
+    def test_emit_stream_overflow(self):
+        self._server.close()
+        overflowed = []
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            bufmax=10,
+            buffer_overflow_handler=overflowed.append,
+        )
+
+        with self._sender as sender:
+            events = [(1, {"n": i}) for i in range(100)]
+            self.assertEqual(
+                sender.emit_stream("foo", events, frame_size=64, timeout=0.1), 0
+            )
+            self.assertIsNone(sender.pendings)
+        self.assertEqual(len(overflowed), 1)
+
+    def test_emit_raw(self):
+        with self._sender as sender:
+            sender.verbose = True
+            self.assertTrue(
+                sender.emit_raw("foo", 1490061367, msgpack.packb({"bar": "baz"}))
+            )
+            self.assertTrue(
+                sender.emit_raw_many(
+                    "foo",
+                    [(1, msgpack.packb({"n": 1})), (None, msgpack.packb({"n": 2}))],
+                )
+            )
+            with self.assertRaises(ValueError):
+                sender.emit_raw("foo", 1, msgpack.packb(["bar"]))
+            with self.assertRaises(ValueError):
+                sender.emit_raw("foo", 1, b"")
+
+        data = self.get_data()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0], ["test.foo", 1490061367, {"bar": "baz"}])
+        self.assertEqual(data[1][1][0], [1, {"n": 1}])
+        self.assertEqual(data[1][1][1][1], {"n": 2})
+
+    def test_oversize_truncate(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, max_record_size=1024, max_field_size=256
+        )
+        with self._sender as sender:
+            self.assertTrue(sender.emit("foo", {"body": "é" * 1000, "status": 200}))
+            self.assertTrue(
+                sender.emit("foo", {"body": b"x" * 1000, "n": list(range(300))})
+            )
+            self.assertTrue(sender.emit("foo", {f"k{i}": "x" * 200 for i in range(8)}))
+            self.assertTrue(sender.emit("foo", {"bar": "baz"}))
+            self.assertEqual(
+                sender.oversize_stats,
+                {"truncated_fields": 6, "dropped_fields": 1, "rejected_records": 0},
+            )
+
+        data = self.get_data()
+        records = [record for _tag, _time, record in data]
+        marker = fluent.sender.TRUNCATION_MARKER
+        self.assertLessEqual(len(msgpack.packb(records[0]["body"])), 256)
+        self.assertTrue(records[0]["body"].startswith("é" * 100))
+        self.assertTrue(records[0]["body"].endswith(marker))
+        self.assertEqual(records[0]["status"], 200)
+        self.assertTrue(records[1]["body"].endswith(marker.encode()))
+        self.assertNotIn("n", records[1])
+        # the largest fields are cut to fit the record
+        self.assertLessEqual(len(msgpack.packb(records[2])), 1024)
+        self.assertEqual(len(records[2]), 8)
+        self.assertEqual(records[3], {"bar": "baz"})
+
+    def test_oversize_drop_field(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            max_record_size=1024,
+            oversize_strategy="drop_field",
+        )
+        with self._sender as sender:
+            record = {"a": "x" * 600, "b": "x" * 500, "c": "x" * 10}
+            self.assertTrue(sender.emit("foo", record))
+            self.assertTrue(
+                sender.emit_raw("foo", 1, msgpack.packb({"a": "x" * 2000, "b": 1}))
+            )
+            self.assertEqual(sender.oversize_stats["dropped_fields"], 2)
+            # non-string keys are kept, undecodable records rejected
+            self.assertTrue(
+                sender.emit_raw("foo", 2, msgpack.packb({1: "x" * 2000, 2: "y"}))
+            )
+            self.assertFalse(
+                sender.emit_raw("foo", 3, b"\x82\x91\x01\x02\xa1a" + b"x" * 2000)
+            )
+            self.assertEqual(sender.oversize_stats["dropped_fields"], 3)
+            self.assertEqual(sender.oversize_stats["rejected_records"], 1)
+
+        self._server.join()
+        data = list(
+            msgpack.Unpacker(
+                BytesIO(self._server._buf.getvalue()), strict_map_key=False
+            )
+        )
+        self.assertEqual(data[0][2], {"b": "x" * 500, "c": "x" * 10})
+        self.assertEqual(data[1][2], {"b": 1})
+        self.assertEqual(data[2][2], {2: "y"})
+        self.assertEqual(len(data), 3)
+
+    def test_oversize_reject(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            max_record_size=1024,
+            max_field_size=256,
+            oversize_strategy="reject",
+        )
+        big = {"body": "x" * 2000}
+        with self._sender as sender:
+            self.assertFalse(sender.emit("foo", big))
+            self.assertIsInstance(sender.last_error, ValueError)
+            self.assertFalse(sender.emit("foo", {"a": "x" * 300}))
+            self.assertFalse(
+                sender.emit_many("foo", [(1, {"n": 1}), (2, big), (3, {"n": 3})])
+            )
+            self.assertFalse(sender.emit_batch([("foo", 1, big), ("bar", 2, {"n": 2})]))
+            self.assertFalse(
+                sender.emit_raw_many(
+                    "foo", [(1, msgpack.packb(big)), (2, msgpack.packb({"n": 2}))]
+                )
+            )
+            self.assertEqual(
+                sender.emit_stream("foo", [(1, big), (2, {"n": 2}), (3, big)]), 1
+            )
+            self.assertEqual(sender.oversize_stats["rejected_records"], 7)
+
+        data = self.get_data()
+        self.assertEqual(data[0], ["test.foo", [[1, {"n": 1}], [3, {"n": 3}]]])
+        self.assertEqual(data[1], ["test.bar", [[2, {"n": 2}]]])
+        self.assertEqual(data[2], ["test.foo", [[2, {"n": 2}]]])
+        self.assertEqual(data[3], ["test.foo", [[2, {"n": 2}]]])
+
+    def test_oversize_keeps_pendings(self):
+        self._server.close()
+        overflowed = []
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            bufmax=1024,
+            max_record_size=512,
+            buffer_overflow_handler=overflowed.append,
+        )
+        with self._sender as sender:
+            self.assertFalse(sender.emit("foo", {"n": 1}))
+            self.assertFalse(sender.emit("foo", {"body": "x" * 10000}))
+            self.assertFalse(overflowed)
+            self.assertLess(len(sender.pendings), 1024)
+            sender.pendings = None
+
+    def test_oversize_strategy_unknown(self):
+        with self.assertRaises(ValueError):
+            fluent.sender.FluentSender(tag="test", oversize_strategy="shorten")
+
     def test_no_last_error_on_successful_emit(self):
         sender = self._sender
         sender.emit("foo", {"bar": "baz"})
@@ -293,6 +654,425 @@ class TestSender(unittest.TestCase):
             finally:
                 self._sender.socket = old_sock
 
+    def test_nonblocking(self):
+        self._server.close()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("localhost", 0))
+        listener.listen(1)
+        # nothing reads from the connection until the emits are done
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=listener.getsockname()[1],
+            nonblocking=True,
+            bufmax=64 * 1024 * 1024,
+        )
+        received = BytesIO()
+
+        def read_all():
+            conn, _ = listener.accept()
+            with conn:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    received.write(data)
+
+        try:
+            sender = self._sender
+            payload = "x" * (1024 * 1024)
+            start = time.monotonic()
+            for i in range(16):
+                self.assertTrue(sender.emit("foo", {"n": i, "payload": payload}))
+            self.assertLess(time.monotonic() - start, sender.timeout)
+            self.assertTrue(sender.pendings)
+            self.assertLess(len(sender.pendings), 16 * len(payload))
+
+            reader = threading.Thread(target=read_all)
+            reader.start()
+            sender.close()
+            reader.join()
+        finally:
+            listener.close()
+
+        received.seek(0)
+        data = list(msgpack.Unpacker(received))
+        self.assertEqual([d[2]["n"] for d in data], list(range(16)))
+
+    def test_nonblocking_outage(self):
+        self._server.close()
+        # a host name would be looked up in the background first
+        self._sender = fluent.sender.FluentSender(
+            tag="test", host="127.0.0.1", port=self._server.port, nonblocking=True
+        )
+        with self._sender as sender:
+            start = time.monotonic()
+            self.assertFalse(sender.emit("foo", {"n": 1}))
+            self.assertEqual(sender.last_error.errno, errno.ECONNREFUSED)
+            # retried only once the backoff delay has passed
+            with unittest.mock.patch("socket.socket") as socket_class:
+                self.assertTrue(sender.emit("foo", {"n": 2}))
+                self.assertFalse(socket_class.called)
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertEqual(len(sender._pendings_frames), 2)
+
+            sender._reconnect_at = 0
+            delay = sender._reconnect_delay
+            self.assertFalse(sender.emit("foo", {"n": 3}))
+            self.assertEqual(sender._reconnect_delay, 2 * delay)
+            sender.pendings = None
+            sender._pendings_frames.clear()
+
+    def test_nonblocking_connect_completes_later(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test", host="127.0.0.1", port=self._server.port, nonblocking=True
+        )
+        with self._sender as sender:
+            with unittest.mock.patch(
+                "fluent.sender._wait_writable", return_value=False
+            ):
+                self.assertTrue(sender.emit("foo", {"n": 1}))
+                self.assertTrue(sender.emit("foo", {"n": 2}))
+            self.assertIsNone(sender.socket)
+            self.assertTrue(sender._connecting)
+            self.assertEqual(len(sender._pendings_frames), 2)
+            self.assertTrue(sender.emit("foo", {"n": 3}))
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1, 2, 3])
+
+    def test_nonblocking_resolves_in_background(self):
+        looked_up = threading.Event()
+        release = threading.Event()
+        getaddrinfo = socket.getaddrinfo
+
+        def slow_getaddrinfo(host, *args):
+            if len(args) < 5:
+                # a name lookup, not a numeric address
+                looked_up.set()
+                release.wait(5)
+            return getaddrinfo(host, *args)
+
+        self._sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, nonblocking=True
+        )
+        with self._sender as sender:
+            with unittest.mock.patch("socket.getaddrinfo", slow_getaddrinfo):
+                start = time.monotonic()
+                self.assertTrue(sender.emit("foo", {"n": 1}))
+                self.assertTrue(looked_up.wait(5))
+                self.assertTrue(sender.emit("foo", {"n": 2}))
+                self.assertLess(time.monotonic() - start, 1.0)
+                self.assertIsNone(sender.socket)
+                release.set()
+                sender._resolver.done.wait(5)
+            self.assertTrue(sender.emit("foo", {"n": 3}))
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1, 2, 3])
+
+    @unittest.skipIf(
+        resource is None or resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1200,
+        "needs more than 1100 open files",
+    )
+    def test_nonblocking_high_fd(self):
+        # beyond FD_SETSIZE, select() can't wait for the socket
+        fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(1100)]
+        try:
+            self._sender.nonblocking = True
+            with self._sender as sender:
+                self.assertTrue(sender.emit("foo", {"n": 1}))
+                self.assertTrue(sender.flush(1.0))
+                self.assertGreaterEqual(sender.socket.fileno(), 1024)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1])
+
+    def test_flush(self):
+        with self._sender as sender:
+            self.assertTrue(sender.flush())
+            # left buffered by an earlier failure
+            sender.pendings = sender._make_packet(
+                "foo", sender._pack_timestamp(1), {"n": 1}
+            )
+            self.assertTrue(sender.flush(1.0))
+            self.assertIsNone(sender.pendings)
+            self.assertTrue(sender.emit("foo", {"n": 2}))
+        self.assertFalse(sender.flush())
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1, 2])
+
+    def test_flush_timeout(self):
+        self._server.close()
+        self._sender = fluent.sender.FluentSender(tag="test", port=self._server.port)
+        with self._sender as sender:
+            self.assertFalse(sender.emit("foo", {"n": 1}))
+            start = time.monotonic()
+            self.assertFalse(sender.flush(0.2))
+            self.assertLess(time.monotonic() - start, 1.0)
+            sender.pendings = None
+
+    def test_nonblocking_flush_priority(self):
+        self._sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, nonblocking=True, flush_priority=40
+        )
+        with self._sender as sender:
+            flush = unittest.mock.patch.object(
+                sender, "_flush_nonblocking", wraps=sender._flush_nonblocking
+            )
+            with flush as flush_nonblocking:
+                with unittest.mock.patch(
+                    "fluent.sender._wait_writable", return_value=False
+                ):
+                    self.assertTrue(sender.emit("foo", {"n": 1}, priority=30))
+                self.assertTrue(sender.pendings)
+                self.assertFalse(flush_nonblocking.called)
+                # written right away, along with the events before it
+                self.assertTrue(sender.emit("foo", {"n": 2}, priority=40))
+                flush_nonblocking.assert_called_once()
+            self.assertIsNone(sender.pendings)
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1, 2])
+
+    def test_nonblocking_overflow_keeps_partial_frame(self):
+        self._sender.nonblocking = True
+        with self._sender as sender:
+            overflows = []
+            sender.buffer_overflow_handler = overflows.append
+            sender.bufmax = 10
+            sender.pendings = b"abcdef"
+            sender._pendings_frames.append(6)
+            sender._pendings_sent = 2
+            sender._overflow_nonblocking()
+            self.assertEqual(sender.pendings, b"abcdef")
+            self.assertFalse(overflows)
+
+            sender.pendings += b"ghijkl"
+            sender._pendings_frames.append(6)
+            sender._overflow_nonblocking()
+            self.assertEqual(sender.pendings, b"abcdef")
+            self.assertEqual(overflows[-1], b"ghijkl")
+            sender.pendings = None
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "fork not supported")
+    def test_fork(self):
+        with self._sender as sender:
+            sender.emit("foo", {"n": 1})
+            self.assertTrue(sender.socket)
+
+            sender.pendings = pending = sender._make_packet("foo", b"\x01", {"n": 0})
+            sender.lock.acquire()
+            state = run_in_child(
+                lambda: {
+                    "socket": sender.socket is None,
+                    "pendings": sender.pendings is None,
+                    "lock": sender.lock.acquire(blocking=False),
+                }
+            )
+            sender.lock.release()
+            self.assertEqual(state, {"socket": True, "pendings": True, "lock": True})
+            self.assertEqual(sender.pendings, pending)
+
+            # the child did not end the parent's connection
+            sender.emit("foo", {"n": 2})
+
+        data = self.get_data()
+        self.assertEqual([d[2]["n"] for d in data], [1, 0, 2])
+
+    def test_tcp_nodelay_default(self):
+        with self._sender as sender:
+            sender.emit("foo", {"bar": "baz"})
+            sock = sender.socket
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+    def test_socket_options(self):
+        self._sender.close()
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            tcp_nodelay=False,
+            send_buffer_size=32768,
+            keepalive=True,
+            keepalive_idle=30,
+            keepalive_interval=5,
+            keepalive_count=3,
+        )
+        with self._sender as sender:
+            sender.emit("foo", {"bar": "baz"})
+            sock = sender.socket
+            self.assertFalse(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            # Linux doubles the requested size for bookkeeping overhead
+            self.assertGreaterEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 32768
+            )
+            self.assertLessEqual(
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 2 * 32768
+            )
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            if hasattr(socket, "TCP_KEEPINTVL"):
+                self.assertEqual(
+                    sock.getsockopt(socket.IPPROTO_TCP, fluent.sender._TCP_KEEPIDLE),
+                    30,
+                )
+                self.assertEqual(
+                    sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL), 5
+                )
+                self.assertEqual(
+                    sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 3
+                )
+
+        data = self.get_data()
+        self.assertEqual(data[0][2], {"bar": "baz"})
+
+    def test_prewarm(self):
+        self._sender.close()
+        self._sender = sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, prewarm=True
+        )
+        self.assertTrue(sender.wait_ready(3))
+        prewarmed = sender._prewarmed
+        self.assertIsNotNone(prewarmed)
+        self.assertIsNone(sender.socket)
+        self.assertTrue(sender.emit("foo", {"bar": "baz"}))
+        self.assertIs(sender.socket, prewarmed)
+        sender.close()
+        data = self._server.get_received()
+        self.assertEqual(data[0][2], {"bar": "baz"})
+
+    @unittest.skipIf(sys.platform == "win32", "Unix socket not supported")
+    def test_prewarm_retries(self):
+        self.tearDown()
+        tmp_dir = mkdtemp()
+        try:
+            server_file = "unix://" + tmp_dir + "/tmp.unix"
+            self._sender = sender = fluent.sender.FluentSender(
+                tag="test", host=server_file, prewarm=True
+            )
+            # nothing listens yet
+            self.assertFalse(sender.wait_ready(0.1))
+            self._server = mockserver.MockRecvServer(server_file)
+            self.assertTrue(sender.wait_ready(3))
+            self.assertTrue(sender.emit("foo", {"bar": "baz"}))
+            sender.close()
+            data = self._server.get_received()
+            self.assertEqual(data[0][2], {"bar": "baz"})
+        finally:
+            rmtree(tmp_dir, True)
+
+    def test_prewarm_stopped_by_close(self):
+        self._sender.close()
+        self._sender = sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, prewarm=True
+        )
+        self.assertTrue(sender.wait_ready(3))
+        sender.close()
+        self.assertIsNone(sender._prewarmed)
+        self.assertEqual(self._server.get_received(), [])
+
+    def test_shared_transport(self):
+        self._sender.close()
+        first = fluent.sender.FluentSender(
+            tag="first", port=self._server.port, shared_transport=True
+        )
+        second = fluent.sender.FluentSender(
+            tag="second", port=self._server.port, shared_transport=True
+        )
+        self._sender = first
+        transport = first._transport
+        self.assertIs(second._transport, transport)
+
+        # the mock server accepts a single connection
+        self.assertTrue(first.emit("foo", {"n": 1}))
+        self.assertTrue(second.emit("foo", {"n": 2}))
+        self.assertTrue(first.emit_many("bar", [(None, {"n": 3})]))
+        self.assertIsNone(first.socket)
+        self.assertTrue(second.flush(1.0))
+
+        first.close()
+        self.assertFalse(first.emit("foo", {"n": 4}))
+        self.assertFalse(transport._closed)
+        self.assertTrue(second.emit("foo", {"n": 5}))
+        second.close()
+        self.assertTrue(transport._closed)
+        self.assertNotIn(transport, [t for t, _ in fluent.sender._transports.values()])
+
+        data = self._server.get_received()
+        self.assertEqual(
+            [(d[0], d[2]["n"]) for d in data[:2]],
+            [("first.foo", 1), ("second.foo", 2)],
+        )
+        self.assertEqual(data[2][0], "first.bar")
+        self.assertEqual(data[2][1][0][1], {"n": 3})
+        self.assertEqual((data[3][0], data[3][2]), ("second.foo", {"n": 5}))
+
+    def test_shared_transport_options(self):
+        first = fluent.sender.FluentSender(
+            tag="first", port=self._server.port, shared_transport=True
+        )
+        second = fluent.sender.FluentSender(
+            tag="second", port=self._server.port, timeout=1.0, shared_transport=True
+        )
+        third = fluent.sender.FluentSender(
+            tag="third",
+            port=self._server.port,
+            nanosecond_precision=True,
+            shared_transport=True,
+        )
+        try:
+            self.assertIsNot(first._transport, second._transport)
+            # packing options are the sender's own
+            self.assertIs(first._transport, third._transport)
+        finally:
+            for sender in (first, second, third):
+                sender.close()
+
+    def test_shared_transport_released_when_collected(self):
+        sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, shared_transport=True
+        )
+        transport = sender._transport
+        del sender
+        gc.collect()
+        self.assertTrue(transport._closed)
+
+    def test_shared_transport_last_error(self):
+        self._sender.close()
+        self._server.close()
+        self._sender = fluent.sender.FluentSender(
+            tag="test", port=self._server.port, shared_transport=True
+        )
+        self.assertFalse(self._sender.emit("foo", {"bar": "baz"}))
+        self.assertIsInstance(self._sender.last_error, OSError)
+
+    @unittest.skipIf(sys.platform == "win32", "Unix socket not supported")
+    def test_unix_socket_send_buffer_size(self):
+        self.tearDown()
+        tmp_dir = mkdtemp()
+        try:
+            server_file = "unix://" + tmp_dir + "/tmp.unix"
+            self._server = mockserver.MockRecvServer(server_file)
+            self._sender = fluent.sender.FluentSender(
+                tag="test", host=server_file, send_buffer_size=32768
+            )
+            with self._sender as sender:
+                self.assertTrue(sender.emit("foo", {"bar": "baz"}))
+                sock = sender.socket
+                self.assertGreaterEqual(
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 32768
+                )
+                self.assertLessEqual(
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 2 * 32768
+                )
+
+            data = self._server.get_received()
+            self.assertEqual(data[0][2], {"bar": "baz"})
+        finally:
+            rmtree(tmp_dir, True)
+
     @unittest.skipIf(sys.platform == "win32", "Unix socket not supported")
     def test_unix_socket(self):
         self.tearDown()
@@ -312,8 +1092,89 @@ class TestSender(unittest.TestCase):
             rmtree(tmp_dir, True)
 
 
+class TestSenderTLS(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._server = mockserver.MockTLSRecvServer("localhost")
+        self._sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            ssl_context=self._server.client_context(),
+        )
+
+    def tearDown(self):
+        try:
+            self._sender.close()
+        finally:
+            self._server.close()
+
+    def test_simple(self):
+        sender = self._sender
+        self.assertTrue(sender.emit("foo", {"bar": "baz"}))
+        self.assertIsInstance(sender.socket, ssl.SSLSocket)
+        sender.close()
+        data = self._server.get_received()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0][0], "test.foo")
+        self.assertEqual(data[0][2], {"bar": "baz"})
+
+    def test_large_record(self):
+        # written in several TLS records and partial sends
+        record = {"message": "x" * (1 << 20)}
+        self.assertTrue(self._sender.emit("foo", record))
+        self._sender.close()
+        data = self._server.get_received()
+        self.assertEqual(data[0][2], record)
+
+    def test_session_reuse(self):
+        self.tearDown()
+        # TLS 1.2 sessions are set up by the handshake, TLS 1.3 tickets are
+        # sent after it
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(mockserver.CERTFILE)
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        self._server = mockserver.MockTLSRecvServer(
+            "localhost", connections=2, context=context
+        )
+        self._sender = sender = fluent.sender.FluentSender(
+            tag="test",
+            port=self._server.port,
+            ssl_context=self._server.client_context(),
+        )
+        self.assertTrue(sender.emit("foo", {"n": 1}))
+        # the connection drops
+        with sender.lock:
+            sender._close()
+        self.assertTrue(sender.emit("foo", {"n": 2}))
+        self.assertTrue(sender.socket.session_reused)
+        sender.close()
+
+        data = self._server.get_received()
+        self.assertEqual([d[2]["n"] for d in data], [1, 2])
+        self.assertEqual(self._server.session_reused, [False, True])
+
+    def test_untrusted_certificate(self):
+        self._sender.ssl_context = ssl.create_default_context()
+        self.assertFalse(self._sender.emit("foo", {"bar": "baz"}))
+        self.assertIsInstance(self._sender.last_error, ssl.SSLCertVerificationError)
+        self.assertIsNone(self._sender.socket)
+
+    def test_nonblocking_unsupported(self):
+        with self.assertRaises(ValueError):
+            fluent.sender.FluentSender(
+                tag="test",
+                ssl_context=self._server.client_context(),
+                nonblocking=True,
+            )
+
+
 class TestEventTime(unittest.TestCase):
     def test_event_time(self):
         time = fluent.sender.EventTime(1490061367.8616468906402588)
         self.assertEqual(time.code, 0)
         self.assertEqual(time.data, b"X\xd0\x8873[\xb0*")
+
+    def test_event_time_from_unix_nano(self):
+        time = fluent.sender.EventTime.from_unix_nano(1490061367861646890)
+        self.assertIsInstance(time, msgpack.ExtType)
+        self.assertEqual(time, (0, b"X\xd0\x8873[\xb0*"))